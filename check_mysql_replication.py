@@ -1,5 +1,8 @@
 #!/usr/bin/env python
 import argparse
+import datetime
+import threading
+import time
 
 from lib import host_utils
 from lib import mysql_lib
@@ -8,15 +11,36 @@ from lib import mysql_lib
 def main():
     parser = argparse.ArgumentParser(description='MySQL replication checker')
     parser.add_argument('replica',
+                        nargs='?',
                         help='Replica MySQL instance to sanity check '
                         'hostname[:port]')
-
+    parser.add_argument('-a',
+                        '--all',
+                        help='Check every slave and dr_slave in zk',
+                        default=False,
+                        action='store_true')
+    parser.add_argument('-i',
+                        '--interval',
+                        help=('With --all and --watch_for_catch_up, seconds '
+                              'between samples'),
+                        default=mysql_lib.LAG_SAMPLE_INTERVAL,
+                        type=int)
     parser.add_argument('-w',
                         '--watch_for_catch_up',
                         help='Watch replication for catch up ',
                         default=False,
                         action='store_true')
     args = parser.parse_args()
+    # Lag checks only run short queries, so do not wait forever on a hung
+    # server
+    mysql_lib.set_io_timeouts(mysql_lib.FLEET_HOST_TIMEOUT,
+                              mysql_lib.FLEET_HOST_TIMEOUT)
+    if args.all:
+        check_all_replication(args.interval, args.watch_for_catch_up)
+        return
+
+    if not args.replica:
+        parser.error('A replica is required unless --all is supplied')
     slave_hostaddr = host_utils.HostAddr(args.replica)
 
     if args.watch_for_catch_up:
@@ -32,5 +56,102 @@ def main():
         print "SQL_lag_binlogs: {sql_binlogs}".format(sql_binlogs=ret['sql_binlogs'])
 
 
+def check_all_replication(interval, watch):
+    """ Print the replication lag of every slave and dr_slave, worst first
+
+    Args:
+    interval - Seconds between samples
+    watch - If True, keep sampling and printing until interrupted. Rates and
+            ETAs are only available from the second sample.
+    """
+    zk = host_utils.MysqlZookeeper()
+    mysql_lib.enable_connection_pool()
+    # Stop retrying replicas which are down on every sample
+    mysql_lib.enable_circuit_breaker()
+    zk_changed = threading.Event()
+    if watch:
+        # Pick up failovers and replacements without rereading the replica
+        # list on every pass
+        watcher = host_utils.start_zk_config_watcher()
+        watcher.subscribe(lambda changed: zk_changed.set())
+    sampler = mysql_lib.ReplicationLagSampler(get_all_replicas(zk))
+    while True:
+        start = time.time()
+        sampler.sample()
+        print_lag_report(sampler.report())
+        if not watch:
+            break
+        time.sleep(max(interval - (time.time() - start), 0))
+        if zk_changed.is_set():
+            zk_changed.clear()
+            sampler.set_replicas(get_all_replicas(zk))
+
+
+def get_all_replicas(zk):
+    """ Get every slave and dr_slave in zk
+
+    Args:
+    zk - A MysqlZookeeper object
+
+    Returns:
+    A set of hostaddr objects
+    """
+    replicas = set()
+    for repl_type in [host_utils.REPLICA_ROLE_SLAVE,
+                      host_utils.REPLICA_ROLE_DR_SLAVE]:
+        replicas = replicas.union(zk.get_all_mysql_instances_by_type(repl_type))
+    return replicas
+
+
+def print_lag_report(report):
+    """ Print the output of ReplicationLagSampler.report as a table
+
+    Args:
+    report - A list of dicts
+    """
+    print ('{replica:<24} {master:<24} {sbm:>10} {sql_bytes:>14} '
+           '{io_bytes:>14} {sbm_rate:>9} {bytes_rate:>12} {eta:>16}'
+           ''.format(replica='replica', master='master', sbm='sbm',
+                     sql_bytes='sql_bytes', io_bytes='io_bytes',
+                     sbm_rate='sbm_rate', bytes_rate='bytes/s', eta='eta'))
+    for entry in report:
+        if entry['error'] is not None:
+            print '{replica:<24} ERROR: {error}'.format(replica=str(entry['replica']),
+                                                        error=entry['error'])
+            continue
+
+        if entry['eta'] is not None:
+            eta = str(datetime.timedelta(seconds=int(entry['eta'])))
+        elif entry['sbm_rate'] is None and entry['bytes_rate'] is None:
+            eta = 'Not yet available'
+        else:
+            eta = 'Not catching up'
+        print ('{replica:<24} {master:<24} {sbm:>10} {sql_bytes:>14} '
+               '{io_bytes:>14} {sbm_rate:>9} {bytes_rate:>12} {eta:>16}'
+               ''.format(replica=str(entry['replica']),
+                         master=str(entry['master']),
+                         sbm=entry['sbm'],
+                         sql_bytes=entry['sql_bytes'],
+                         io_bytes=entry['io_bytes'],
+                         sbm_rate=format_rate(entry['sbm_rate'], '{:.2f}x'),
+                         bytes_rate=format_rate(entry['bytes_rate'], '{:.0f}'),
+                         eta=eta))
+
+
+def format_rate(rate, fmt):
+    """ Format a rate which may be None
+
+    Args:
+    rate - A float or None
+    fmt - A format string for a float
+
+    Returns:
+    A string
+    """
+    if rate is None:
+        return '-'
+    return fmt.format(rate)
+
+
 if __name__ == "__main__":
     main()
@@ -1,8 +1,12 @@
 #!/usr/bin/env python
 import argparse
+import sys
+from lib import environment_specific
 from lib import host_utils
 from lib import mysql_lib
 
+log = environment_specific.setup_logging_defaults(__name__)
+
 
 def main():
     description = ("MySQL orpahned shard detector\n\n"
@@ -16,13 +20,17 @@ def main():
                         help='Check a single instance rather than all',
                         default=False)
     args = parser.parse_args()
+    mysql_lib.enable_connection_pool()
+    mysql_lib.set_io_timeouts(mysql_lib.FLEET_HOST_TIMEOUT,
+                              mysql_lib.FLEET_HOST_TIMEOUT)
 
     if args.instance:
         instance = host_utils.HostAddr(args.instance)
     else:
         instance = False
 
-    orphaned, orphaned_but_used, missing = find_shard_mismatches(instance)
+    (orphaned, orphaned_but_used,
+     missing, errors) = find_shard_mismatches(instance)
 
     for orphan in orphaned:
         print 'Orphan dbs {host} {dbs}'.format(host=orphan,
@@ -34,7 +42,13 @@ def main():
         print 'Missing dbs {host} {dbs}'.format(host=orphan,
                                                 dbs=','.join(missing[orphan]))
 
-    if not orphaned and not orphaned_but_used and not missing:
+    for instance in errors:
+        print 'Could not check {host}: {e}'.format(host=instance,
+                                                  e=errors[instance])
+
+    if errors:
+        sys.exit(1)
+    elif not orphaned and not orphaned_but_used and not missing:
         print "No problems found"
 
 
@@ -51,7 +65,9 @@ def find_shard_mismatches(instance=False):
                         Data strucutre is the same as orphaned.
     missing - A dict of expected but missing shards.
               Data strucutre is the same as orphaned.
-
+    errors - A dict keyed by hostaddr of the exception raised while checking
+             an instance. Results from the other instances are still
+             returned.
     """
     orphaned = dict()
     orphaned_but_used = dict()
@@ -65,12 +81,18 @@ def find_shard_mismatches(instance=False):
         new_host_shard_map[instance.__str__()] = host_shard_map[instance.__str__()]
         host_shard_map = new_host_shard_map
 
+    masters = dict()
     for master in host_shard_map:
+        masters[host_utils.HostAddr(master)] = master
+    (dbs, errors) = mysql_lib.run_on_instances(masters.keys(), get_instance_dbs)
+    for instance in errors:
+        log.error('Could not check {i}: {e}'.format(i=instance,
+                                                   e=errors[instance]))
+
+    for instance in dbs:
+        master = masters[instance]
         expected_shards = host_shard_map[master]
-        instance = host_utils.HostAddr(master)
-        conn = mysql_lib.connect_mysql(instance)
-        activity = mysql_lib.get_dbs_activity(conn)
-        actual_shards = mysql_lib.get_dbs(conn)
+        (activity, actual_shards) = dbs[instance]
         unexpected_shards = actual_shards.difference(expected_shards)
         missing = expected_shards.difference(actual_shards)
         if missing:
@@ -86,7 +108,21 @@ def find_shard_mismatches(instance=False):
                     orphaned[master] = set()
                 orphaned[master].add(db)
 
-    return orphaned, orphaned_but_used, missing_shards
+    return orphaned, orphaned_but_used, missing_shards, errors
+
+
+def get_instance_dbs(instance):
+    """ Get the dbs on an instance along with their activity
+
+    Args:
+    instance - A hostaddr object
+
+    Returns:
+    activity - A dict of db activity, see mysql_lib.get_dbs_activity
+    dbs - A set of dbs
+    """
+    conn = mysql_lib.connect_mysql(instance)
+    return mysql_lib.get_dbs_activity(conn), mysql_lib.get_dbs(conn)
 
 
 if __name__ == "__main__":
@@ -77,7 +77,9 @@ def rename_db_to_drop(instance, dbs, verbose=False, dry_run=False):
     dry_run - bool, will make no changes to
     """
     # confirm db is not in zk and not in use
-    orphaned, _, _ = find_shard_mismatches.find_shard_mismatches(instance)
+    orphaned, _, _, errors = find_shard_mismatches.find_shard_mismatches(instance)
+    if errors:
+        raise Exception('Could not check {i} for orphans'.format(i=instance))
     if not orphaned:
         print "Detected no orphans"
         sys.exit(1)
@@ -92,7 +94,6 @@ def rename_db_to_drop(instance, dbs, verbose=False, dry_run=False):
     # confirm that renames would not be blocked by an existing table
     conn = mysql_lib.connect_mysql(instance)
 
-    cursor = conn.cursor()
     for db in dbs:
         renamed_db = ''.join((DB_PREPEND, db))
 
@@ -106,13 +107,12 @@ def rename_db_to_drop(instance, dbs, verbose=False, dry_run=False):
 
         params = {'old_db': db,
                   'new_db': renamed_db}
-        cursor = conn.cursor()
-        cursor.execute(sql, params)
-        dups = cursor.fetchall()
+        blocked = False
+        for dup in mysql_lib.stream_query(conn, sql, params):
+            print "Table rename blocked by {tbl}".format(tbl=dup['tbl'])
+            blocked = True
 
-        if dups:
-            for dup in dups:
-                print "Table rename blocked by {tbl}".format(tbl=dup['tbl'])
+        if blocked:
             sys.exit(1)
 
         # We should be safe to create the new db and rename
@@ -136,7 +136,9 @@ def drop_db_after_rename(instance, dbs, verbose, dry_run):
     """
 
     # confirm db is not in zk and not in use
-    orphaned, _, _ = find_shard_mismatches.find_shard_mismatches(instance)
+    orphaned, _, _, errors = find_shard_mismatches.find_shard_mismatches(instance)
+    if errors:
+        raise Exception('Could not check {i} for orphans'.format(i=instance))
     instance_orphans = orphaned[instance.__str__()]
     unexpected = dbs.difference(instance_orphans)
     if unexpected:
@@ -147,28 +149,33 @@ def drop_db_after_rename(instance, dbs, verbose, dry_run):
     # make sure the original db is empty
     conn = mysql_lib.connect_mysql(instance)
     cursor = conn.cursor()
+    catalog = mysql_lib.get_catalog(conn, refresh=True)
     for db in dbs:
-        if mysql_lib.get_tables(conn, db):
+        if catalog.get_tables(db):
             print ''.join(("Cowardly refusing to drop non-empty db:",
                            db))
             sys.exit(1)
 
-    for db in dbs:
-        # we should be good to drop the old empty dbs
-        raw_sql = 'DROP DATABASE IF EXISTS `{db}`;'
-        sql = raw_sql.format(db=db)
-        if verbose:
-            print sql
-        if not dry_run:
-            cursor.execute(sql)
-
-        # and we should be ok to drop the non-empty 'dropme_' prepended db
-        renamed_db = ''.join((DB_PREPEND, db))
-        sql = raw_sql.format(db=renamed_db)
-        if verbose:
-            print sql
+    try:
+        for db in dbs:
+            # we should be good to drop the old empty dbs
+            raw_sql = 'DROP DATABASE IF EXISTS `{db}`;'
+            sql = raw_sql.format(db=db)
+            if verbose:
+                print sql
+            if not dry_run:
+                cursor.execute(sql)
+
+            # and we should be ok to drop the non-empty 'dropme_' prepended db
+            renamed_db = ''.join((DB_PREPEND, db))
+            sql = raw_sql.format(db=renamed_db)
+            if verbose:
+                print sql
+            if not dry_run:
+                cursor.execute(sql)
+    finally:
         if not dry_run:
-            cursor.execute(sql)
+            mysql_lib.invalidate_catalog(conn)
 
 
 if __name__ == "__main__":
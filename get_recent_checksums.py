@@ -85,17 +85,22 @@ def get_checksums(instance, db=False):
     vars_for_query['instance'] = instance
 
     zk = host_utils.MysqlZookeeper()
-    host_shard_map = zk.get_host_shard_map()
 
     if db is False:
+        (replica_set, _) = zk.get_replica_set_from_instance(instance,
+                                                            rtypes=[host_utils.REPLICA_ROLE_MASTER])
         cnt = 0
         shard_param_set = set()
-        for entry in host_shard_map[instance.__str__()]:
+        for entry in zk.iter_replica_set_shards(replica_set):
             key = ''.join(('shard', str(cnt)))
             vars_for_query[key] = entry
             shard_param_set.add(key)
             cnt += 1
 
+        if not shard_param_set:
+            # The master owns no shards, so there can be no checksums
+            return list()
+
         shard_param = ''.join(('%(',
                                ')s,%('.join(shard_param_set),
                                ')s'))
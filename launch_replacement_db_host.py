@@ -434,7 +434,8 @@ def get_master_mysql_major_version(instance):
     master = zk.get_mysql_instance_from_replica_set(instance.get_zk_replica_set()[0],
                                                     repl_type=host_utils.REPLICA_ROLE_MASTER)
     master_conn = mysql_lib.connect_mysql(master)
-    mysql_version = mysql_lib.get_global_variables(master_conn)['version'][:3]
+    mysql_version = mysql_lib.get_global_variables(master_conn,
+                                                   ['version'])['version'][:3]
     return mysql_version
 
 
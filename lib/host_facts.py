@@ -0,0 +1,150 @@
+import json
+import os
+import subprocess
+import time
+
+from lib import environment_specific
+
+FACT_EC2_INSTANCE_ID = 'ec2_instance_id'
+FACT_EC2_INSTANCE_TYPE = 'ec2_instance_type'
+FACT_PINFO_CLOUD = 'pinfo_cloud'
+FACTER_FACTS = [FACT_PINFO_CLOUD, FACT_EC2_INSTANCE_TYPE, FACT_EC2_INSTANCE_ID]
+FACTER_CMD = 'facter {facts}'
+HOST_FACTS_CACHE_FILE = '/tmp/mysql_utils_host_facts.json'
+# How long collected facts are trusted, in seconds
+HOST_FACTS_TTL = 300
+
+# Facts collected by this process, see get_host_facts()
+_host_facts = None
+
+log = environment_specific.setup_logging_defaults(__name__)
+
+
+def get_host_facts(refresh=False):
+    """ Get facts about the localhost. Facts are collected with a single
+        facter run and cached both in process and on disk for
+        HOST_FACTS_TTL seconds.
+
+    Args:
+    refresh - Ignore any cached facts
+
+    Returns:
+    A dict of facts.
+
+    Example:
+    {'collected_at': 1434747892.6,
+     'ec2_instance_id': 'i-8a7e1f2b',
+     'ec2_instance_type': 'i2.4xlarge',
+     'facter_error': '',
+     'pinfo_cloud': 'aws'}
+    """
+    global _host_facts
+    if not refresh:
+        if _host_facts is not None and is_fresh(_host_facts):
+            return _host_facts
+
+        facts = read_host_facts_cache()
+        if facts is not None:
+            _host_facts = facts
+            return facts
+
+    facts = collect_host_facts()
+    write_host_facts_cache(facts)
+    _host_facts = facts
+    return facts
+
+
+def clear_host_facts():
+    """ Forget all cached facts, both in process and on disk """
+    global _host_facts
+    _host_facts = None
+    try:
+        os.unlink(HOST_FACTS_CACHE_FILE)
+    except OSError:
+        pass
+
+
+def is_fresh(facts):
+    """ Check if facts were collected within HOST_FACTS_TTL
+
+    Args:
+    facts - A dict from collect_host_facts()
+
+    Returns:
+    True if the facts may still be used
+    """
+    return 0 <= time.time() - facts['collected_at'] < HOST_FACTS_TTL
+
+
+def collect_host_facts():
+    """ Gather facts about the localhost
+
+    Returns:
+    A dict of facts, see get_host_facts()
+    """
+    facts = dict()
+    for fact in FACTER_FACTS:
+        facts[fact] = ''
+
+    cmd = FACTER_CMD.format(facts=' '.join(FACTER_FACTS))
+    # host_utils.shell_exec is not used as host_utils imports this module
+    proc = subprocess.Popen(cmd,
+                            shell=True,
+                            stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE)
+    (std_out, std_err) = proc.communicate()
+    facts['facter_error'] = std_err
+    # When asked for several facts, facter prints 'fact => value' lines
+    for line in std_out.splitlines():
+        if ' => ' in line:
+            (fact, value) = line.split(' => ', 1)
+            if fact.strip() in facts:
+                facts[fact.strip()] = value.strip()
+
+    facts['collected_at'] = time.time()
+    return facts
+
+
+def read_host_facts_cache():
+    """ Read facts cached on disk by another process
+
+    Returns:
+    A dict of facts, or None if there are no usable cached facts
+    """
+    try:
+        with open(HOST_FACTS_CACHE_FILE) as f:
+            # Only trust a cache we wrote ourselves
+            if os.fstat(f.fileno()).st_uid != os.getuid():
+                return None
+            facts = json.loads(f.read())
+    except (IOError, OSError, ValueError):
+        return None
+
+    if (not isinstance(facts, dict) or 'collected_at' not in facts or
+            not is_fresh(facts)):
+        return None
+    for fact in FACTER_FACTS:
+        if fact not in facts:
+            return None
+    return facts
+
+
+def write_host_facts_cache(facts):
+    """ Save facts to disk for other processes. Failure is not fatal.
+
+    Args:
+    facts - A dict from collect_host_facts()
+    """
+    tmp_file = '.'.join((HOST_FACTS_CACHE_FILE, str(os.getpid()), 'tmp'))
+    try:
+        # O_EXCL so that we never follow a planted symlink in /tmp
+        fd = os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0644)
+        with os.fdopen(fd, 'w') as f:
+            f.write(json.dumps(facts))
+        os.rename(tmp_file, HOST_FACTS_CACHE_FILE)
+    except (IOError, OSError) as e:
+        log.debug('Could not write host facts cache: {e}'.format(e=e))
+        try:
+            os.unlink(tmp_file)
+        except OSError:
+            pass
@@ -1,14 +1,23 @@
+import bisect
 import ConfigParser
+import ctypes
+import ctypes.util
 import fcntl
 import json
+import marshal
+import mmap
 import os
 import re
+import select
 import shutil
 import socket
+import struct
 import subprocess
+import threading
 import time
 import getpass
 
+import host_facts
 import mysql_lib
 from lib import environment_specific
 from lib import timeout
@@ -43,6 +52,9 @@ REPLICA_TYPES = [REPLICA_ROLE_MASTER,
                  REPLICA_ROLE_SLAVE,
                  REPLICA_ROLE_DR_SLAVE]
 TESTING_DATA_DIR = '/tmp/'
+HOSTADDR_PARSE_CACHE_SIZE = 10000
+OLD_STYLE_HOSTNAME_RE = re.compile('([a-zA-z]+)0+([0-9]+)([a-z])')
+OLD_STYLE_DB_HOSTNAME_RE = re.compile('([a-zA-z0-9]+db)0+([0-9]+)([a-z])')
 TESTING_PINFO_CLOUD = 'vagrant'
 
 # /raid0 and /mnt are interchangable; use whichever one we have.
@@ -54,9 +66,49 @@ INIT_CMD = '/etc/init.d/mysqld_multi {options} {action} {port}'
 PTKILL_CMD = '/usr/sbin/service pt-kill-{port} {action}'
 PTHEARTBEAT_CMD = '/usr/sbin/service pt-heartbeat-{port} {action}'
 ZK_CACHE = [MYSQL_DS_ZK, MYSQL_DR_ZK, MYSQL_GEN_ZK]
+# A marshal'ed copy of the parsed zk cache files and their indexes. It is
+# only used if it was built from files with the current ZK_CACHE signature.
+MYSQL_ZK_SNAPSHOT = '/var/config/mysql_utils.zk_snapshot'
+# Where the compiled snapshot is kept by users who can not write to
+# /var/config
+MYSQL_ZK_USER_SNAPSHOT = '/tmp/mysql_utils.zk_snapshot.{uid}'
+ZK_SNAPSHOT_MAGIC = 'mysql_utils_zk_snapshot'
+# Bump when the layout of ZK_SNAPSHOT_FIELDS changes
+ZK_SNAPSHOT_VERSION = (1, marshal.version)
+ZK_SNAPSHOT_FIELDS = ['ds', 'gen', 'dr', 'all', 'instance_index',
+                      'hostname_index', 'standardized_index']
+ZK_WATCH_POLL_INTERVAL = 5
+ZK_WATCH_SETTLE_TIME = .1
+
+# inotify(7) IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+INOTIFY_MASK = 0x00000008 | 0x00000080 | 0x00000100
+# struct inotify_event: wd, mask, cookie, len, followed by name
+INOTIFY_EVENT_FORMAT = 'iIII'
+INOTIFY_EVENT_SIZE = struct.calcsize(INOTIFY_EVENT_FORMAT)
 
 log = environment_specific.setup_logging_defaults(__name__)
 
+# The most recently parsed copy of the zk cache files, see
+# get_zk_config_snapshot()
+_zk_snapshot = None
+_zk_snapshot_lock = threading.Lock()
+# Bumped by a ZkConfigWatcher whenever a zk cache file is written. A
+# snapshot taken under an older generation is reparsed even if the files'
+# signature looks unchanged, as an in place rewrite may keep the same size
+# within the mtime resolution.
+_zk_generation = 0
+# Process wide ZkConfigWatcher, see start_zk_config_watcher()
+_zk_watcher = None
+# Set once a warning has been logged that no compiled snapshot could be saved
+_zk_snapshot_write_warned = False
+# Shard range indexes keyed by db name preface, see get_shard_indexes()
+_shard_indexes = None
+# Parsed MySQL cnf files keyed by file name. Values are a tuple of the file's
+# (mtime, size, inode) and a RawConfigParser. See get_cnf_parser()
+_cnf_cache = dict()
+# Parsed host strings, see parse_hostaddr()
+_hostaddr_parse_cache = dict()
+
 
 def take_flock_lock(file_name):
     """ Take a flock for throw an exception
@@ -285,8 +337,560 @@ def upgrade_auth_tables(port):
     stop_mysql(port)
 
 
+def get_zk_cache_signature():
+    """ Describe the current state of the zk cache files on disk
+
+    Returns:
+    A tuple of (file name, mtime, size, inode) tuples, one per file in
+    ZK_CACHE. If any of these change the files have been rewritten.
+    """
+    signature = list()
+    for zk_file in ZK_CACHE:
+        st = os.stat(zk_file)
+        signature.append((zk_file, st.st_mtime, st.st_size, st.st_ino))
+    return tuple(signature)
+
+
+class ZkConfigSnapshot(object):
+    """ A parsed point in time copy of the zk cache files.
+
+    The dicts held by a snapshot are shared by every caller, so they must
+    be treated as read only.
+    """
+
+    def __init__(self, generation=0, use_compiled=True):
+        """
+        Args:
+        generation - The value of _zk_generation before reading the files
+        use_compiled - If False, always parse the zk cache files rather than
+                       loading a compiled snapshot with the same signature
+        """
+        # The signature and generation are taken before reading, so a
+        # rewrite that races with the read will make the snapshot look
+        # stale on the next check.
+        self.generation = generation
+        self.signature = get_zk_cache_signature()
+        if not use_compiled or not self._load_compiled():
+            self._build()
+            self._write_compiled()
+
+        # Memoized results of MysqlZookeeper.get_host_shard_map, keyed by
+        # replica type
+        self.host_shard_maps = dict()
+
+    def _build(self):
+        """ Parse the zk cache files and build all indexes """
+        self.ds = self._load(MYSQL_DS_ZK)
+        self.gen = self._load(MYSQL_GEN_ZK)
+        self.dr = self._load(MYSQL_DR_ZK)
+
+        # Copy each replica set so that adding the dr_slave does not
+        # modify the ds/gen dicts
+        self.all = dict()
+        for config in (self.gen, self.ds):
+            for replica_set in config:
+                self.all[replica_set] = dict(config[replica_set])
+
+        for key in self.dr:
+            self.all[key][REPLICA_ROLE_DR_SLAVE] = \
+                self.dr[key][REPLICA_ROLE_DR_SLAVE]
+
+        # Reverse indexes from instance to replica set. In a sane config
+        # each list holds a single entry.
+        # (hostname, port) -> [(replica_set, role), ...]
+        self.instance_index = dict()
+        # hostname -> [(replica_set, role, port), ...]
+        self.hostname_index = dict()
+        for replica_set in self.all:
+            for rtype in REPLICA_TYPES:
+                if rtype not in self.all[replica_set]:
+                    continue
+                host = self.all[replica_set][rtype]
+                key = (host['host'], host['port'])
+                self.instance_index.setdefault(key, list()).append((replica_set,
+                                                                    rtype))
+                self.hostname_index.setdefault(host['host'], list()).append(
+                    (replica_set, rtype, host['port']))
+
+        # get_standardized_replica_set() of each master -> (replica_set, role)
+        self.standardized_index = dict()
+        for replica_set in self.all:
+            if REPLICA_ROLE_MASTER not in self.all[replica_set]:
+                continue
+            host = self.all[replica_set][REPLICA_ROLE_MASTER]
+            master = HostAddr(''.join((host['host'], ':', str(host['port']))))
+            standardized = master.get_standardized_replica_set()
+            if standardized:
+                self.standardized_index.setdefault(standardized,
+                                                   (replica_set,
+                                                    REPLICA_ROLE_MASTER))
+
+    def _load(self, zk_file):
+        """ Parse a zk cache file
+
+        Args:
+        zk_file - The file to read
+
+        Returns:
+        The deserialized json from the file
+        """
+        with open(zk_file) as f:
+            return json.loads(f.read())
+
+    def _load_compiled(self):
+        """ Load the parsed config and indexes from MYSQL_ZK_SNAPSHOT, if it
+            was compiled from the current zk cache files
+
+        Returns:
+        True if the compiled snapshot was loaded, False otherwise
+        """
+        for snapshot_file in get_zk_snapshot_files():
+            try:
+                with open(snapshot_file, 'rb') as f:
+                    # Do not trust a file in /tmp planted by someone else
+                    if (snapshot_file != MYSQL_ZK_SNAPSHOT and
+                            os.fstat(f.fileno()).st_uid != os.getuid()):
+                        continue
+                    mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                    try:
+                        compiled = marshal.loads(mapped)
+                    finally:
+                        mapped.close()
+                (magic, version, signature, fields) = compiled
+            except (EnvironmentError, EOFError, ValueError, TypeError):
+                continue
+
+            if (magic != ZK_SNAPSHOT_MAGIC or version != ZK_SNAPSHOT_VERSION or
+                    signature != self.signature):
+                continue
+
+            for field in ZK_SNAPSHOT_FIELDS:
+                setattr(self, field, fields[field])
+            return True
+        return False
+
+    def _write_compiled(self):
+        """ Save the parsed config and indexes to MYSQL_ZK_SNAPSHOT, or the
+            per user MYSQL_ZK_USER_SNAPSHOT if that is not writable, so other
+            processes can skip parsing the json. Failure is not fatal.
+        """
+        global _zk_snapshot_write_warned
+        fields = dict()
+        for field in ZK_SNAPSHOT_FIELDS:
+            fields[field] = getattr(self, field)
+
+        errors = list()
+        for snapshot_file in get_zk_snapshot_files():
+            tmp_file = '.'.join((snapshot_file, str(os.getpid()), 'tmp'))
+            try:
+                with open(tmp_file, 'wb') as f:
+                    marshal.dump((ZK_SNAPSHOT_MAGIC, ZK_SNAPSHOT_VERSION,
+                                  self.signature, fields), f)
+                os.rename(tmp_file, snapshot_file)
+                return
+            except (EnvironmentError, ValueError) as e:
+                log.debug('Could not write compiled zk snapshot to '
+                          '{f}: {e}'.format(f=snapshot_file, e=e))
+                errors.append(e)
+                try:
+                    os.unlink(tmp_file)
+                except OSError:
+                    pass
+
+        if not _zk_snapshot_write_warned:
+            _zk_snapshot_write_warned = True
+            log.warning('Could not write a compiled zk snapshot, every process '
+                        'will parse the zk cache files: '
+                        '{e}'.format(e=errors[-1]))
+
+    def is_current(self):
+        """ Check if the zk cache files have changed since this snapshot
+            was taken
+
+        Returns:
+        True if the files on disk are unchanged, False otherwise
+        """
+        if self.generation != _zk_generation:
+            return False
+        try:
+            return self.signature == get_zk_cache_signature()
+        except OSError:
+            return False
+
+
+def get_zk_snapshot_files():
+    """ Get the locations a compiled zk snapshot may be kept, in order of
+        preference
+
+    Returns:
+    A list of file names
+    """
+    uid = os.getuid()
+    if uid == 0:
+        return [MYSQL_ZK_SNAPSHOT]
+    return [MYSQL_ZK_SNAPSHOT, MYSQL_ZK_USER_SNAPSHOT.format(uid=uid)]
+
+
+def get_zk_config_snapshot():
+    """ Get a parsed copy of the zk cache files. The files are only reparsed
+        if their mtime, size or inode has changed since the last parse, or
+        if a ZkConfigWatcher has seen them written.
+
+    Returns:
+    A ZkConfigSnapshot object
+    """
+    global _zk_snapshot
+    snapshot = _zk_snapshot
+    if snapshot is not None and snapshot.is_current():
+        return snapshot
+
+    with _zk_snapshot_lock:
+        if _zk_snapshot is not snapshot and _zk_snapshot.is_current():
+            # Another thread beat us to it
+            return _zk_snapshot
+        # A compiled snapshot is matched on signature alone, so it can not
+        # be trusted when a watcher saw a write the signature missed.
+        use_compiled = True
+        if _zk_snapshot is not None:
+            try:
+                use_compiled = (_zk_snapshot.signature !=
+                                get_zk_cache_signature())
+            except OSError:
+                pass
+        _zk_snapshot = ZkConfigSnapshot(_zk_generation, use_compiled)
+        return _zk_snapshot
+
+
+def bump_zk_generation():
+    """ Mark every existing zk snapshot as stale """
+    global _zk_generation
+    with _zk_snapshot_lock:
+        _zk_generation += 1
+
+
+def diff_zk_config_snapshots(old_snapshot, new_snapshot):
+    """ Find the replica sets which differ between two snapshots
+
+    Args:
+    old_snapshot - A ZkConfigSnapshot
+    new_snapshot - A ZkConfigSnapshot
+
+    Returns:
+    A set of replica sets which were added, removed or modified
+    """
+    changed = set()
+    for replica_set in set(old_snapshot.all).union(new_snapshot.all):
+        if (old_snapshot.all.get(replica_set) !=
+                new_snapshot.all.get(replica_set)):
+            changed.add(replica_set)
+    return changed
+
+
+class ZkConfigWatcher(threading.Thread):
+    """ Background thread which reloads the zk snapshot whenever the zk
+        updater writes a cache file, and tells subscribers which replica
+        sets changed. Uses inotify when available, otherwise polls the
+        files' signature.
+
+    Readers still go through get_zk_config_snapshot, which checks the
+    signature as always. The watcher only adds a generation bump on top of
+    that, so it can make a snapshot stale sooner but never keeps a stale
+    one alive.
+    """
+
+    def __init__(self, poll_interval=ZK_WATCH_POLL_INTERVAL,
+                 force_polling=False):
+        """
+        Args:
+        poll_interval - Seconds between checks of the zk cache files when
+                        inotify is not available
+        force_polling - Do not attempt to use inotify
+        """
+        threading.Thread.__init__(self, name='ZkConfigWatcher')
+        self.daemon = True
+        self.poll_interval = poll_interval
+        self.subscribers = list()
+        self.inotify_fd = None
+        self._stop_event = threading.Event()
+        if not force_polling:
+            self.inotify_fd = self._setup_inotify()
+
+    def _setup_inotify(self):
+        """ Watch the directories holding the zk cache files
+
+        Returns:
+        An inotify file descriptor or None if inotify is not available
+        """
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            fd = libc.inotify_init()
+            if fd < 0:
+                raise OSError(ctypes.get_errno(), 'inotify_init failed')
+            for directory in set(os.path.dirname(f) for f in ZK_CACHE):
+                if libc.inotify_add_watch(fd, directory, INOTIFY_MASK) < 0:
+                    os.close(fd)
+                    raise OSError(ctypes.get_errno(),
+                                  'inotify_add_watch failed on '
+                                  '{dir}'.format(dir=directory))
+        except (AttributeError, OSError) as e:
+            log.warning('inotify is unavailable, falling back to polling '
+                        'every {interval} seconds: '
+                        '{e}'.format(interval=self.poll_interval, e=e))
+            return None
+        return fd
+
+    def subscribe(self, callback):
+        """ Register a function to be called after the snapshot changes
+
+        Args:
+        callback - A callable which will be passed a set of changed replica
+                   sets. It is run from the watcher thread, so it should
+                   do little more than record that a change happened.
+        """
+        self.subscribers.append(callback)
+
+    def stop(self):
+        """ Ask the watcher thread to exit """
+        self._stop_event.set()
+
+    def run(self):
+        snapshot = self._reload(None)
+        while not self._stop_event.is_set():
+            if self.inotify_fd is not None:
+                if self._wait_for_inotify():
+                    # Let a burst of writes to the several files settle
+                    time.sleep(ZK_WATCH_SETTLE_TIME)
+                    self._drain_inotify()
+                    bump_zk_generation()
+            else:
+                self._stop_event.wait(self.poll_interval)
+            snapshot = self._reload(snapshot)
+
+        if self.inotify_fd is not None:
+            os.close(self.inotify_fd)
+            self.inotify_fd = None
+
+    def _wait_for_inotify(self):
+        """ Block until one of the zk cache files has been written
+
+        Returns:
+        True if a zk cache file changed, False on timeout
+        """
+        ready, _, _ = select.select([self.inotify_fd], [], [],
+                                    self.poll_interval)
+        if not ready:
+            return False
+        zk_files = set(os.path.basename(f) for f in ZK_CACHE)
+        return bool(zk_files.intersection(self._drain_inotify()))
+
+    def _drain_inotify(self):
+        """ Read all pending inotify events
+
+        Returns:
+        A set of file names which had events
+        """
+        names = set()
+        while select.select([self.inotify_fd], [], [], 0)[0]:
+            buf = os.read(self.inotify_fd, 65536)
+            pos = 0
+            while pos + INOTIFY_EVENT_SIZE <= len(buf):
+                (_, _, _, name_len) = struct.unpack_from(INOTIFY_EVENT_FORMAT,
+                                                         buf, pos)
+                pos += INOTIFY_EVENT_SIZE
+                names.add(buf[pos:pos + name_len].rstrip('\0'))
+                pos += name_len
+        return names
+
+    def _reload(self, old_snapshot):
+        """ Get the current snapshot and notify subscribers of any changes
+
+        Args:
+        old_snapshot - The snapshot from the previous reload, or None
+
+        Returns:
+        The current ZkConfigSnapshot, or old_snapshot if it could not be
+        loaded
+        """
+        try:
+            new_snapshot = get_zk_config_snapshot()
+        except Exception as e:
+            # Likely caught a file half written, try again on the next event
+            log.warning('Could not reload zk config: {e}'.format(e=e))
+            return old_snapshot
+
+        if old_snapshot is None or old_snapshot is new_snapshot:
+            return new_snapshot
+
+        changed = diff_zk_config_snapshots(old_snapshot, new_snapshot)
+        if changed:
+            log.info('zk config changed for replica sets: '
+                     '{changed}'.format(changed=', '.join(sorted(changed))))
+            for callback in self.subscribers:
+                try:
+                    callback(changed)
+                except Exception as e:
+                    log.exception(e)
+        return new_snapshot
+
+
+def start_zk_config_watcher(poll_interval=ZK_WATCH_POLL_INTERVAL,
+                            force_polling=False):
+    """ Start a process wide zk config watcher, if not already running
+
+    Args:
+    poll_interval - Seconds between checks of the zk cache files when
+                    inotify is not available
+    force_polling - Do not attempt to use inotify
+
+    Returns:
+    A ZkConfigWatcher object
+    """
+    global _zk_watcher
+    if _zk_watcher is None or not _zk_watcher.is_alive():
+        _zk_watcher = ZkConfigWatcher(poll_interval, force_polling)
+        _zk_watcher.start()
+    return _zk_watcher
+
+
+def stop_zk_config_watcher():
+    """ Stop the process wide zk config watcher """
+    global _zk_watcher
+    watcher = _zk_watcher
+    _zk_watcher = None
+    if watcher is not None:
+        watcher.stop()
+        watcher.join()
+
+
+class ShardRangeIndex(object):
+    """ An interval index of a shard mapping. Shard names are never
+        materialized unless explicitly iterated.
+    """
+
+    def __init__(self, mapping, preface, zpad):
+        """
+        Args:
+        mapping - A list of dicts representing shard ranges mapping to
+                  a replica set. Example:
+                  {'range':(    0,   63), 'host':'db00001'}
+        preface - The preface of the db name. Formula for dbname is
+                  preface + z padded shard number
+        zpad - The amount of z padding to use
+        """
+        self.preface = preface
+        self.zpad = zpad
+        # Parallel lists sorted by the start of the range
+        self.starts = list()
+        self.ends = list()
+        self.replica_sets = list()
+        # Note there may be multiple ranges for each replica set
+        self.ranges = dict()
+        # Note: host in this context means replica set name
+        for entry in sorted(mapping, key=lambda e: e['range'][0]):
+            (start, end) = entry['range']
+            self.starts.append(start)
+            self.ends.append(end)
+            self.replica_sets.append(entry['host'])
+            self.ranges.setdefault(entry['host'], list()).append((start, end))
+
+    def shard_name(self, shard_num):
+        """ Convert a shard number to a db name
+
+        Args:
+        shard_num - An int
+
+        Returns:
+        A string, ie pbdata00123
+        """
+        return ''.join((self.preface, str(shard_num).zfill(self.zpad)))
+
+    def shard_num(self, shard):
+        """ Convert a db name to a shard number
+
+        Args:
+        shard - A db name, ie pbdata00123
+
+        Returns:
+        An int, or None if the name is not a shard name of this index
+        """
+        if not shard.startswith(self.preface):
+            return None
+        num = shard[len(self.preface):]
+        if not num.isdigit() or str(int(num)).zfill(self.zpad) != num:
+            return None
+        return int(num)
+
+    def get_replica_set(self, shard):
+        """ Find the replica set that holds a shard
+
+        Args:
+        shard - A db name, ie pbdata00123
+
+        Returns:
+        A replica set name, or None if the shard is not mapped
+        """
+        shard_num = self.shard_num(shard)
+        if shard_num is None:
+            return None
+        pos = bisect.bisect_right(self.starts, shard_num) - 1
+        if pos < 0 or shard_num > self.ends[pos]:
+            return None
+        return self.replica_sets[pos]
+
+    def get_ranges(self, replica_set):
+        """ Get the shard ranges held by a replica set
+
+        Args:
+        replica_set - A replica set name
+
+        Returns:
+        A list of inclusive (start, end) tuples
+        """
+        return list(self.ranges.get(replica_set, ()))
+
+    def iter_shards(self, replica_set):
+        """ Lazily generate the shard names held by a replica set
+
+        Args:
+        replica_set - A replica set name
+
+        Returns:
+        A generator of db names
+        """
+        for (start, end) in self.ranges.get(replica_set, ()):
+            for shard_num in xrange(start, end + 1):
+                yield self.shard_name(shard_num)
+
+
+def get_shard_indexes():
+    """ Get the shard range indexes for sharddb and modsharddb
+
+    Returns:
+    A dict with a key of the db name preface and a value of a
+    ShardRangeIndex
+    """
+    global _shard_indexes
+    if _shard_indexes is None:
+        _shard_indexes = {
+            SHARDDB_PREFACE: ShardRangeIndex(environment_specific.SHARD_MAPPING,
+                                             SHARDDB_PREFACE,
+                                             SHARDDB_ZPAD),
+            MODSHARDDB_PREFACE: ShardRangeIndex(environment_specific.MOD_SHARD_MAPPING,
+                                                MODSHARDDB_PREFACE,
+                                                MODSHARDDB_ZPAD)}
+    return _shard_indexes
+
+
+class UnknownShardError(Exception):
+    pass
+
+
 class MysqlZookeeper:
-    """Class for reading MySQL settings stored on the filesystem"""
+    """Class for reading MySQL settings stored on the filesystem
+
+    All methods read from a shared ZkConfigSnapshot, so the dicts returned
+    must not be modified by callers.
+    """
 
     def get_ds_mysql_config(self):
         """ Query for Data Services MySQL shard mappings.
@@ -304,10 +908,7 @@ class MysqlZookeeper:
                   u'user': u'pbuser'},
         ...
         """
-        with open(MYSQL_DS_ZK) as f:
-            ds = json.loads(f.read())
-
-        return ds
+        return get_zk_config_snapshot().ds
 
     def get_gen_mysql_config(self):
         """ Query for non-Data Services MySQL shard mappings.
@@ -325,10 +926,7 @@ class MysqlZookeeper:
                                 u'user': u'redacted'},
         ...
         """
-        with open(MYSQL_GEN_ZK) as f:
-            gen = json.loads(f.read())
-
-        return gen
+        return get_zk_config_snapshot().gen
 
     def get_dr_mysql_config(self):
         """ Query for disaster recovery MySQL shard mappings.
@@ -341,10 +939,7 @@ class MysqlZookeeper:
          u'db00015': {u'dr_slave': {u'host': u'sharddb015g', u'port': 3306}},
         ...
         """
-        with open(MYSQL_DR_ZK) as f:
-            dr = json.loads(f.read())
-
-        return dr
+        return get_zk_config_snapshot().dr
 
     def get_all_mysql_config(self):
         """ Get all MySQL shard mappings.
@@ -371,15 +966,7 @@ class MysqlZookeeper:
                                 u'user': u'redacted'},
         ...
         """
-        mapping_dict = self.get_gen_mysql_config()
-        mapping_dict.update(self.get_ds_mysql_config())
-
-        dr = self.get_dr_mysql_config()
-        for key in dr:
-            mapping_dict[key][REPLICA_ROLE_DR_SLAVE] = \
-                dr[key][REPLICA_ROLE_DR_SLAVE]
-
-        return mapping_dict
+        return get_zk_config_snapshot().all
 
     def get_all_mysql_replica_sets(self):
         """ Get a list of all MySQL replica sets
@@ -485,40 +1072,64 @@ class MysqlZookeeper:
         replica_set - A replica set which the instance is part
         replica_type - The role of the instance in the replica_set
         """
-        config = self.get_all_mysql_config()
-        for replica_set in config:
-            for rtype in rtypes:
-                if rtype in config[replica_set]:
-                    if (instance.hostname == config[replica_set][rtype]['host'] and
-                            instance.port == config[replica_set][rtype]['port']):
-                        return (replica_set, rtype)
+        snapshot = get_zk_config_snapshot()
+        entries = snapshot.instance_index.get((instance.hostname,
+                                               instance.port), ())
+        for replica_set, rtype in entries:
+            if rtype in rtypes:
+                return (replica_set, rtype)
         raise Exception('{instance} is not in zk for replication '
                         'role(s): {rtypes}'.format(instance=instance,
                                                    rtypes=rtypes))
 
+    def get_replica_sets_from_hostname(self, hostname):
+        """ Get all replica sets a host has a role in, regardless of port
+
+        Args:
+        hostname - A hostname, ie sharddb001a
+
+        Returns:
+        A list of (replica_set, replica_type, port) tuples, empty if the host
+        is not in zk.
+        """
+        return list(get_zk_config_snapshot().hostname_index.get(hostname, ()))
+
     def get_host_shard_map(self, repl_type=REPLICA_ROLE_MASTER):
         """ Get a mapping of what shards exist on MySQL master servers
 
+        Args:
+        repl_type - Optional, a replica type with valid options are entries
+                    in REPLICA_TYPES. Default is 'master'.
+
         Returns:
         A dict with a key of the MySQL master instance and the value a set
-        of shards
+        of shards. The map is built once per zk snapshot and shared between
+        callers, so it must not be modified.
         """
-        shard_map = dict()
-        sharddb_map = self.compute_shard_map(environment_specific.SHARD_MAPPING,
-                                             SHARDDB_PREFACE,
-                                             SHARDDB_ZPAD)
-        modsharddb_map = self.compute_shard_map(environment_specific.MOD_SHARD_MAPPING,
-                                                MODSHARDDB_PREFACE,
-                                                MODSHARDDB_ZPAD)
-        shard_map.update(sharddb_map)
-        shard_map.update(modsharddb_map)
+        if repl_type not in REPLICA_TYPES:
+            raise Exception('Invalid repl_type {repl_type}. Valid options are'
+                            '{REPLICA_TYPES}'.format(repl_type=repl_type,
+                                                     REPLICA_TYPES=REPLICA_TYPES))
 
-        host_shard_map = dict()
-        for replica_set in shard_map:
-            instance = self.get_mysql_instance_from_replica_set(replica_set,
-                                                                repl_type)
-            host_shard_map[instance.__str__()] = shard_map[replica_set]
+        snapshot = get_zk_config_snapshot()
+        host_shard_map = snapshot.host_shard_maps.get(repl_type)
+        if host_shard_map is not None:
+            return host_shard_map
 
+        host_shard_map = dict()
+        for index in get_shard_indexes().itervalues():
+            for replica_set in index.ranges:
+                if replica_set not in snapshot.all:
+                    raise Exception('Unknown replica set '
+                                    '{replica_set}'.format(replica_set=replica_set))
+                if repl_type not in snapshot.all[replica_set]:
+                    continue
+                host = snapshot.all[replica_set][repl_type]
+                key = ''.join((host['host'], ':', str(host['port'])))
+                shards = host_shard_map.setdefault(key, set())
+                shards.update(index.iter_shards(replica_set))
+
+        snapshot.host_shard_maps[repl_type] = host_shard_map
         return host_shard_map
 
     def compute_shard_map(self, mapping, preface, zpad):
@@ -536,19 +1147,43 @@ class MysqlZookeeper:
         A dict with a key of the replica set name and the value being
         a set of strings which are shard names
         """
+        index = ShardRangeIndex(mapping, preface, zpad)
         shard_mapping = dict()
-        # Note there may be multiple ranges for each replica set
-        for replica_set in mapping:
-            for shard_num in range(replica_set['range'][0],
-                                   replica_set['range'][1] + 1):
-                shard_name = ''.join((preface, str(shard_num).zfill(zpad)))
-                # Note: host in this context means replica set name
-                if replica_set['host'] not in shard_mapping:
-                    shard_mapping[replica_set['host']] = set()
-                shard_mapping[replica_set['host']].add(shard_name)
+        for replica_set in index.ranges:
+            shard_mapping[replica_set] = set(index.iter_shards(replica_set))
 
         return shard_mapping
 
+    def iter_replica_set_shards(self, replica_set):
+        """ Lazily generate all shard names held by a replica set
+
+        Args:
+        replica_set - A replica set name
+
+        Returns:
+        A generator of db names
+        """
+        for index in get_shard_indexes().itervalues():
+            for shard in index.iter_shards(replica_set):
+                yield shard
+
+    def shard_to_replica_set(self, shard):
+        """ Convert a shard to a replica set
+
+        Args:
+        shard - A shard name
+
+        Returns:
+        A replica set name
+        """
+        for index in get_shard_indexes().itervalues():
+            replica_set = index.get_replica_set(shard)
+            if replica_set:
+                return replica_set
+
+        raise UnknownShardError('Could not determine shard replica set for '
+                                'shard {shard}'.format(shard=shard))
+
     def shard_to_instance(self, shard, repl_type=REPLICA_ROLE_MASTER):
         """ Convert a shard to  hostname
 
@@ -559,17 +1194,76 @@ class MysqlZookeeper:
         Returns:
         A hostaddr object for an instance of the replica set
         """
-        shard_map = self.get_host_shard_map(repl_type)
+        replica_set = self.shard_to_replica_set(shard)
+        instance = self.get_mysql_instance_from_replica_set(replica_set,
+                                                            repl_type)
+        if not instance:
+            raise Exception('Replica set {replica_set} for shard {shard} has '
+                            'no {repl_type}'.format(replica_set=replica_set,
+                                                    shard=shard,
+                                                    repl_type=repl_type))
+        return instance
 
-        for instance in shard_map:
-            if shard in shard_map[instance]:
-                return HostAddr(instance)
 
-        raise Exception('Could not determine shard replica set for shard {shard}'.format(shard=shard))
+def parse_hostaddr(host):
+    """ Split a host string into the parts HostAddr is made of. Results are
+        cached as the same few thousand hosts get parsed over and over.
+
+    Args:
+    host - A hostname with an optional port, ie sharddb001a:3306
 
+    Returns:
+    A tuple of (hostname, port, replica_type, replica_set_num,
+    host_identifier, str_form)
+    """
+    parsed = _hostaddr_parse_cache.get(host)
+    if parsed is not None:
+        return parsed
+
+    replica_type = None
+    replica_set_num = None
+    host_identifier = None
+
+    host_params = host.split(':')
+    hostname = host_params[0].split('.')[0]
+    if len(host_params) > 1:
+        port = int(host_params[1])
+    else:
+        port = 3306
 
-class HostAddr:
+    # New style hostnames are of the form replicaType-replicaSetNum-hostNum
+    # ie: sharddb-1-1
+    try:
+        (replica_type, replica_set_num, host_identifier) = hostname.split('-')
+    except ValueError:
+        # Maybe a old sytle hostname
+        # form is replicaTypereplicaSetNumhostLetter
+        # ie: sharddb001a
+        replica_set_match = OLD_STYLE_HOSTNAME_RE.match(hostname)
+        if replica_set_match:
+            (replica_type, replica_set_num, host_identifier) = \
+                replica_set_match.groups()
+        else:
+            replica_set_match = OLD_STYLE_DB_HOSTNAME_RE.match(hostname)
+            if replica_set_match:
+                (replica_type, replica_set_num, host_identifier) = \
+                    replica_set_match.groups()
+                replica_type = ''.join((replica_type, 'db'))
+            # Otherwise not an old style hostname either, weird.
+
+    parsed = (hostname, port, replica_type, replica_set_num, host_identifier,
+              ''.join((hostname, ':', str(port))))
+    if len(_hostaddr_parse_cache) >= HOSTADDR_PARSE_CACHE_SIZE:
+        _hostaddr_parse_cache.clear()
+    _hostaddr_parse_cache[host] = parsed
+    return parsed
+
+
+class HostAddr(object):
     """Basic abtraction for hostnames"""
+    __slots__ = ('hostname', 'port', 'replica_type', 'replica_set_num',
+                 'host_identifier', '_str', '_hash')
+
     def __init__(self, host):
         """
         Args:
@@ -577,42 +1271,9 @@ class HostAddr:
                {replicaType}-{replicaSetNum}-{hostNum} - new style
                {replicaType}{replicaSetNum}{hostLetter} - old style
         """
-        self.replica_type = None
-        self.replica_set_num = None
-        self.host_identifier = None
-
-        host_params = re.split(':', host)
-        self.hostname = re.split('\.', host_params[0])[0]
-        if len(host_params) > 1:
-            self.port = int(host_params[1])
-        else:
-            self.port = 3306
-
-        # New style hostnames are of the form replicaType-replicaSetNum-hostNum
-        # ie: sharddb-1-1
-        try:
-            (self.replica_type, self.replica_set_num,
-             self.host_identifier) = self.hostname.split('-')
-        except ValueError:
-            # Maybe a old sytle hostname
-            # form is replicaTypereplicaSetNumhostLetter
-            # ie: sharddb001a
-            replica_set_match = re.match('([a-zA-z]+)0+([0-9]+)([a-z])', self.hostname)
-            if replica_set_match:
-                try:
-                    (self.replica_type, self.replica_set_num, self.host_identifier)\
-                        = replica_set_match.groups()
-                except ValueError:
-                    # Not an old style hostname either, weird.
-                    pass
-            else:
-                replica_set_match = re.match('([a-zA-z0-9]+db)0+([0-9]+)([a-z])', self.hostname)
-                try:
-                    (self.replica_type, self.replica_set_num, self.host_identifier)\
-                        = replica_set_match.groups()
-                    self.replica_type = ''.join((self.replica_type, 'db'))
-                except:
-                    pass
+        (self.hostname, self.port, self.replica_type, self.replica_set_num,
+         self.host_identifier, self._str) = parse_hostaddr(host)
+        self._hash = hash(self._str)
 
     def get_standardized_replica_set(self):
         """ Return an easily parsible replica set name
@@ -631,12 +1292,13 @@ class HostAddr:
         """ Determine what replica set a host would belong to
 
         Returns:
-        A replica set name
+        A tuple of (replica_set, 'master') for the replica set whose master
+        shares this host's standardized replica set name, or None
         """
-        zk = MysqlZookeeper()
-        for master in zk.get_all_mysql_instances_by_type(REPLICA_ROLE_MASTER):
-            if self.get_standardized_replica_set() == master.get_standardized_replica_set():
-                return zk.get_replica_set_from_instance(master)
+        standardized = self.get_standardized_replica_set()
+        if not standardized:
+            return None
+        return get_zk_config_snapshot().standardized_index.get(standardized)
 
     def __str__(self):
         """
@@ -644,25 +1306,23 @@ class HostAddr:
         a  human readible string version of object similar to
         'shardb123a:3309'
         """
-        return ''.join((self.hostname, ':', str(self.port)))
+        return self._str
 
     def __repr__(self):
-        return str(self)
+        return self._str
 
     def __eq__(self, other):
-        if (self.hostname == other.hostname and self.port == other.port):
-            return 1
-        else:
-            return 0
+        if not isinstance(other, HostAddr):
+            return NotImplemented
+        return self._str == other._str
 
     def __ne__(self, other):
-        if (self.hostname != other.hostname or self.port != other.port):
-            return 1
-        else:
-            return 0
+        if not isinstance(other, HostAddr):
+            return NotImplemented
+        return self._str != other._str
 
     def __hash__(self):
-        return hash(''.join((self.hostname, ':', str(self.port))))
+        return self._hash
 
 
 def shell_exec(cmd):
@@ -689,15 +1349,15 @@ def shell_exec(cmd):
     return (std_out, std_err, return_code)
 
 
-def get_cnf_setting(variable, port):
-    """ Get the value of a variab from a mysql cnf
+def get_cnf_file_and_group(port):
+    """ Find where the settings of a MySQL instance are configured
 
     Args:
-    variable - a MySQL variable located in configuration file
     port - Which instance of mysql, ie 3306.
 
     Returns:
-    The value of the variable in the configuration file
+    cnf - The configuration file
+    group - The section of the configuration file for the instance
     """
     if get_hiera_role() in MASTERFUL_PUPPET_ROLES:
         cnf = OLD_CONF_ROOT.format(port=str(port))
@@ -705,10 +1365,71 @@ def get_cnf_setting(variable, port):
     else:
         cnf = MYSQL_CNF_FILE
         group = 'mysqld{port}'.format(port=port)
-    parser = ConfigParser.RawConfigParser(allow_no_value=True)
-    if not os.path.exists(cnf):
+    return cnf, group
+
+
+def get_cnf_parser(cnf):
+    """ Get a parsed MySQL configuration file. The file is only reparsed if
+        its mtime, size or inode has changed or invalidate_cnf_cache() has
+        been called.
+
+    Args:
+    cnf - A MySQL configuration file
+
+    Returns:
+    A RawConfigParser object, which must not be modified
+    """
+    try:
+        st = os.stat(cnf)
+    except OSError:
         raise Exception("MySQL conf {cnf} does not exist".format(cnf=cnf))
+    signature = (st.st_mtime, st.st_size, st.st_ino)
+
+    cached = _cnf_cache.get(cnf)
+    if cached is not None and cached[0] == signature:
+        return cached[1]
+
+    parser = ConfigParser.RawConfigParser(allow_no_value=True)
     parser.read(cnf)
+    _cnf_cache[cnf] = (signature, parser)
+    return parser
+
+
+def invalidate_cnf_cache():
+    """ Forget all parsed MySQL configuration files, ie after rewriting
+        them.
+    """
+    _cnf_cache.clear()
+
+
+def get_cnf_settings(port):
+    """ Get all settings of a mysql instance from its cnf
+
+    Args:
+    port - Which instance of mysql, ie 3306.
+
+    Returns:
+    A dict with a key of the variable name, lowercased by ConfigParser but
+    otherwise as written in the configuration file (ie dashes are not
+    converted to underscores), and a value of the setting. Any settings
+    in a [DEFAULT] section are included.
+    """
+    cnf, group = get_cnf_file_and_group(port)
+    return dict(get_cnf_parser(cnf).items(group))
+
+
+def get_cnf_setting(variable, port):
+    """ Get the value of a variab from a mysql cnf
+
+    Args:
+    variable - a MySQL variable located in configuration file
+    port - Which instance of mysql, ie 3306.
+
+    Returns:
+    The value of the variable in the configuration file
+    """
+    cnf, group = get_cnf_file_and_group(port)
+    parser = get_cnf_parser(cnf)
 
     try:
         value = parser.get(group, variable)
@@ -778,6 +1499,12 @@ def get_local_instance_id():
     Returns:
     A string with the aws instance_id or None
     """
+    instance_id = host_facts.get_host_facts()[host_facts.FACT_EC2_INSTANCE_ID]
+    if instance_id:
+        return instance_id
+
+    # Only ask the metadata service when facter did not know, as it can be
+    # slow to fail on hosts outside of ec2
     (out, err, ret) = shell_exec('ec2metadata --instance-id')
     if out.strip():
         return out.strip()
@@ -803,12 +1530,12 @@ def get_pinfo_cloud():
 
     Returns pinfo_cloud
     """
-    (std_out, std_err, return_code) = shell_exec('facter pinfo_cloud')
+    pinfo_cloud = host_facts.get_host_facts()[host_facts.FACT_PINFO_CLOUD]
 
-    if not std_out:
+    if not pinfo_cloud:
         return DEFAULT_PINFO_CLOUD
 
-    return std_out.strip()
+    return pinfo_cloud
 
 
 def get_instance_type():
@@ -817,11 +1544,10 @@ def get_instance_type():
     Returns:
     A string describing the hardware of the server
     """
+    facts = host_facts.get_host_facts()
 
-    (std_out, std_err, return_code) = shell_exec('facter ec2_instance_type')
-
-    if not std_out:
+    if not facts[host_facts.FACT_EC2_INSTANCE_TYPE]:
         raise Exception('Could not determine hardware, error:'
-                        '{std_err}'.format(std_err=std_err))
+                        '{std_err}'.format(std_err=facts['facter_error']))
 
-    return std_out.strip()
+    return facts[host_facts.FACT_EC2_INSTANCE_TYPE]
@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 import argparse
 import json
+import os
 
 AUTH_FILE = '/var/config/config.services.mysql_auth'
 MYSQL_DS_ZK = '/var/config/config.services.dataservices.mysql_databases'
@@ -10,6 +11,11 @@ SLAVE = 'slave'
 DR_SLAVE = 'dr_slave'
 REPLICA_ROLES = [MASTER, SLAVE, DR_SLAVE]
 
+# Parsed json files and the indexes built from them, keyed by file name.
+# Values are a tuple of the file signature, the deserialized json and a dict
+# of index builder to index. See get_file_index()
+_file_indexes = dict()
+
 
 def main():
     parser = argparse.ArgumentParser()
@@ -72,37 +78,20 @@ def get_mysql_connection(replica_set_name, writeable=False,
     if replica_set_role is None:
         replica_set_role = MASTER
 
-    with open(MYSQL_DS_ZK) as f:
-        ds = json.loads(f.read())
-
-    for entry in ds.iteritems():
-        if replica_set_name == entry[0]:
-            hostname = entry[1][replica_set_role]['host']
-            port = entry[1][replica_set_role]['port']
-
-    if hostname is None or port is None:
-        with open(MYSQL_GEN_ZK) as f:
-            gen = json.loads(f.read())
-
-        for entry in gen.iteritems():
-            if replica_set_name == entry[0]:
-                hostname = entry[1][replica_set_role]['host']
-                port = entry[1][replica_set_role]['port']
+    for zk_file in (MYSQL_DS_ZK, MYSQL_GEN_ZK):
+        replica_sets = get_file_index(zk_file, build_replica_set_index)
+        if replica_set_name in replica_sets:
+            (hostname, port) = replica_sets[replica_set_name][replica_set_role]
+            break
 
     if hostname is None or port is None:
         err = ("Replica set '{rs}' does not exist in zk"
                ''.format(rs=replica_set_name))
         raise NameError(err)
 
-    with open(AUTH_FILE) as f:
-        grants = json.loads(f.read())
-
-    for entry in grants.iteritems():
-        if user_role == entry[0]:
-            for user in entry[1]['users']:
-                if user['enabled'] is True:
-                    username = user['username']
-                    password = user['password']
+    user_roles = get_file_index(AUTH_FILE, build_user_role_index)
+    if user_role in user_roles:
+        (username, password) = user_roles[user_role]
 
     if username is None or password is None:
         err = ("Userrole '{role}' does not exist in zk"
@@ -111,5 +100,76 @@ def get_mysql_connection(replica_set_name, writeable=False,
     return hostname, port, username, password
 
 
+def get_file_index(file_name, builder=None):
+    """ Get an index of a json file. The file is only reparsed, and the index
+    rebuilt, if the file's mtime, size or inode has changed. Indexes built by
+    different builders share a single parse of the file.
+
+    Args:
+    file_name - The json file to read
+    builder - A function which turns the deserialized json into an index. If
+              not supplied, the deserialized json is returned.
+
+    Returns:
+    The return of builder. This is shared between callers and must not be
+    modified.
+    """
+    try:
+        st = os.stat(file_name)
+    except OSError as e:
+        raise IOError(e.errno, e.strerror, file_name)
+    signature = (st.st_mtime, st.st_size, st.st_ino)
+
+    cached = _file_indexes.get(file_name)
+    if cached is None or cached[0] != signature:
+        with open(file_name) as f:
+            cached = (signature, json.loads(f.read()), dict())
+        _file_indexes[file_name] = cached
+
+    (_, parsed, indexes) = cached
+    if builder is None:
+        return parsed
+    if builder not in indexes:
+        indexes[builder] = builder(parsed)
+    return indexes[builder]
+
+
+def build_replica_set_index(config):
+    """ Index a replica set configuration file
+
+    Args:
+    config - The deserialized contents of MYSQL_DS_ZK or MYSQL_GEN_ZK
+
+    Returns:
+    A dict of {replica_set: {role: (hostname, port)}}
+    """
+    index = dict()
+    for replica_set, entry in config.iteritems():
+        index[replica_set] = dict()
+        for role in REPLICA_ROLES:
+            if role in entry:
+                index[replica_set][role] = (entry[role]['host'],
+                                            entry[role]['port'])
+    return index
+
+
+def build_user_role_index(grants):
+    """ Index the auth file
+
+    Args:
+    grants - The deserialized contents of AUTH_FILE
+
+    Returns:
+    A dict of {user_role: (username, password)} holding the last enabled
+    user of each role
+    """
+    index = dict()
+    for user_role, entry in grants.iteritems():
+        for user in entry['users']:
+            if user['enabled'] is True:
+                index[user_role] = (user['username'], user['password'])
+    return index
+
+
 if __name__ == "__main__":
     main()
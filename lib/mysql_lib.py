@@ -1,10 +1,19 @@
-import json
+import atexit
+import bisect
+import collections
 import datetime
+import json
+import math
 import MySQLdb
 import MySQLdb.cursors
+import os
+import Queue
 import re
+import sys
+import threading
 import time
 import warnings
+import weakref
 
 import _mysql_exceptions
 
@@ -21,6 +30,10 @@ MAX_HEARTBEAT_LAG = 120
 HEARTBEAT_SAFETY_MARGIN = 10
 
 AUTH_FILE = '/var/config/config.services.mysql_auth'
+# Consecutive connection failures after which an instance is not retried
+# for CIRCUIT_BREAKER_COOLDOWN seconds
+CIRCUIT_BREAKER_THRESHOLD = 3
+CIRCUIT_BREAKER_COOLDOWN = 60
 CONNECT_TIMEOUT = 2
 METADATA_DB = 'test'
 MYSQLADMIN = '/usr/bin/mysqladmin'
@@ -32,7 +45,66 @@ MYSQL_ERROR_NO_DEFINED_GRANT = 1141
 MYSQL_ERROR_NO_SUCH_THREAD = 1094
 MYSQL_ERROR_UNKNOWN_VAR = 1193
 MYSQL_ERROR_FUNCTION_EXISTS = 1125
+MYSQL_ERROR_UNKNOWN_HOST = 2005
+MYSQL_ERROR_SERVER_GONE = 2006
+MYSQL_ERROR_SERVER_LOST = 2013
+# Errors on connect which suggest the instance is unreachable, rather than
+# for example that we have the wrong password
+MYSQL_UNREACHABLE_ERRORS = set([MYSQL_ERROR_CONN_HOST_ERROR,
+                                MYSQL_ERROR_UNKNOWN_HOST,
+                                MYSQL_ERROR_SERVER_GONE,
+                                MYSQL_ERROR_SERVER_LOST])
 MYSQL_VERSION_COMMAND = '/usr/sbin/mysqld --version'
+# Pooled connections idle for longer than this are reopened rather than
+# health checked
+POOL_MAX_IDLE_SECONDS = 300
+# Max idle pooled connections to a single instance
+POOL_MAX_PER_HOST = 16
+# Defaults for run_on_instances: max instances worked on at once, seconds
+# allowed per instance and seconds allowed for the entire run
+FLEET_MAX_WORKERS = 32
+FLEET_HOST_TIMEOUT = 60
+FLEET_TIMEOUT = 1800
+# Seconds to wait on a socket read or write to an instance before giving
+# up, see set_io_timeouts(). None waits forever, which is the default as
+# some statements (ie SET GLOBAL read_only) may legitimately block for a
+# long time. Lag checks and fleet sweeps only run short queries, so they
+# use FLEET_HOST_TIMEOUT.
+READ_TIMEOUT = None
+WRITE_TIMEOUT = None
+# Default seconds between samples taken by ReplicationLagSampler, and the
+# number of samples it uses to estimate rates
+LAG_SAMPLE_INTERVAL = 10
+LAG_RATE_WINDOW = 6
+# Bounds in seconds on how often replication waits sample lag
+REPLICATION_POLL_MIN_INTERVAL = 1
+REPLICATION_POLL_MAX_INTERVAL = 300
+# Max seconds between checks by kill_long_trx for killed transactions
+KILL_LONG_TRX_POLL_INTERVAL = .5
+# Rows fetched from the server at a time by stream_query
+STREAM_FETCH_SIZE = 1000
+# Seconds a CatalogSnapshot is reused by get_catalog
+CATALOG_TTL = 60
+# Seconds a global variable is reused by get_cached_global_variables
+GLOBAL_VARIABLES_TTL = 60
+# Upper bounds in seconds of the query latency histogram buckets
+QUERY_LATENCY_BUCKETS = [.001, .002, .005, .01, .02, .05, .1, .2, .5, 1, 2, 5,
+                         10, 30, 60, 300]
+# Functions of this module which only run queries on behalf of their caller.
+# Query stats are booked to the caller instead.
+QUERY_STATS_SKIP_FUNCTIONS = set(['stream_query', 'query_rows', 'iter_dbs',
+                                  'iter_tables', 'iter_dbs_activity',
+                                  'iter_user_activity'])
+# Setting this in the environment turns on query stats for a process
+QUERY_STATS_ENV = 'MYSQL_UTILS_QUERY_STATS'
+# Setting this in the environment to a path also writes a JSON trace of every
+# query there at exit
+QUERY_TRACE_ENV = 'MYSQL_UTILS_QUERY_TRACE'
+# Max queries kept for the JSON trace
+QUERY_TRACE_MAX = 100000
+# Schemas which get_dbs does not consider to be databases
+SYSTEM_DBS = set(['mysql', 'information_schema', 'performance_schema',
+                  'test'])
 
 
 class ReplicationError(Exception):
@@ -47,8 +119,41 @@ class InvalidVariableForOperation(Exception):
     pass
 
 
+class FleetTimeout(Exception):
+    pass
+
+
+class PollTimeout(Exception):
+    pass
+
+
+class InstanceUnreachable(MySQLdb.OperationalError):
+    """ Raised instead of connecting to an instance which has recently failed
+        repeatedly. Has the same args as a failure to connect so that
+        existing error handling treats it the same way.
+    """
+    pass
+
+
 log = environment_specific.setup_logging_defaults(__name__)
 
+# Process wide ConnectionPool, see enable_connection_pool()
+_connection_pool = None
+# Process wide CircuitBreaker, see enable_circuit_breaker()
+_circuit_breaker = None
+# Cleared once MySQLdb.connect has rejected read_timeout and write_timeout,
+# as MySQL-python 1.2.5 and older do. See new_mysql_connection()
+_io_timeouts_supported = True
+# connection -> CatalogSnapshot, see get_catalog()
+_catalogs = weakref.WeakKeyDictionary()
+# connection -> {variable: (value, fetched at)}, see
+# get_cached_global_variables()
+_global_variables = weakref.WeakKeyDictionary()
+# Process wide QueryStats, see enable_query_stats()
+_query_stats = None
+# Cursor class -> its timed subclass, see get_timed_cursor_class()
+_timed_cursor_classes = dict()
+
 
 def get_all_mysql_grants():
     """Fetch all MySQL grants
@@ -104,14 +209,33 @@ def get_mysql_user_for_role(role):
     username - string of the username enabled for the role
     password - string of the password enabled for the role
     """
-    grants = get_mysql_auth_roles()[role]
-    for user in grants['users']:
-        if user['enabled']:
-            return user['username'], user['password']
+    users = mysql_connect.get_file_index(AUTH_FILE, build_role_user_index)
+    return users[role]
+
+
+def build_role_user_index(auth_roles):
+    """ Index the first enabled user of each role
+
+    Args:
+    auth_roles - The deserialized contents of AUTH_FILE
+
+    Returns:
+    A dict with a key of the role and a value of a (username, password)
+    tuple, or None if the role has no enabled user
+    """
+    index = dict()
+    for role, grants in auth_roles.iteritems():
+        index[role] = None
+        for user in grants['users']:
+            if user['enabled']:
+                index[role] = (user['username'], user['password'])
+                break
+    return index
 
 
 def get_mysql_auth_roles():
-    """Get all mysql roles from zk updater
+    """Get all mysql roles from zk updater. The file is only reparsed when it
+    changes, and the dict returned is shared so it must not be modified.
 
     Returns:
     a dict describing the replication status.
@@ -127,9 +251,7 @@ def get_mysql_auth_roles():
                          u'enabled': False}]},
 ...
 """
-    with open(AUTH_FILE) as f:
-        json_grants = json.loads(f.read())
-    return json_grants
+    return mysql_connect.get_file_index(AUTH_FILE)
 
 
 def connect_mysql(instance, role='admin'):
@@ -142,7 +264,9 @@ def connect_mysql(instance, role='admin'):
            exit in zk.
 
     Returns:
-    a connection to the server as administrator
+    a connection to the server as administrator. If the connection pool has
+    been enabled, this is a PooledConnection which goes back to the pool
+    when it is closed.
     """
     if role == 'bootstrap':
         socket = host_utils.get_cnf_setting('socket', instance.port)
@@ -153,17 +277,838 @@ def connect_mysql(instance, role='admin'):
                              passwd=password,
                              cursorclass=MySQLdb.cursors.DictCursor)
 
+    elif _connection_pool is not None:
+        db = _connection_pool.get_connection(instance, role)
     else:
-        username, password = get_mysql_user_for_role(role)
-        db = MySQLdb.connect(host=instance.hostname,
-                             port=instance.port,
-                             user=username,
-                             passwd=password,
-                             cursorclass=MySQLdb.cursors.DictCursor,
-                             connect_timeout=CONNECT_TIMEOUT)
+        db = new_mysql_connection(instance, role)
+
+    if _query_stats is not None:
+        db.cursorclass = TimedDictCursor
+        db.cursor = timed_cursor_method(db.cursor)
+        db.query_stats_host = str(instance)
     return db
 
 
+def new_mysql_connection(instance, role='admin', read_timeout=None):
+    """Open a new TCP connection to a MySQL instance, bypassing any pool
+
+    Args:
+    instance - object describing which mysql instance to connect to
+    role - a string of the name of the mysql role to use
+    read_timeout - Seconds to wait on a socket read, if not READ_TIMEOUT
+
+    Returns:
+    a connection to the server
+    """
+    global _io_timeouts_supported
+    username, password = get_mysql_user_for_role(role)
+    if read_timeout is None:
+        read_timeout = READ_TIMEOUT
+    kwargs = dict()
+    if _io_timeouts_supported:
+        if read_timeout is not None:
+            kwargs['read_timeout'] = read_timeout
+        if WRITE_TIMEOUT is not None:
+            kwargs['write_timeout'] = WRITE_TIMEOUT
+
+    breaker = _circuit_breaker
+    if breaker is not None:
+        breaker.check(instance)
+    try:
+        try:
+            conn = MySQLdb.connect(host=instance.hostname,
+                                   port=instance.port,
+                                   user=username,
+                                   passwd=password,
+                                   cursorclass=MySQLdb.cursors.DictCursor,
+                                   connect_timeout=CONNECT_TIMEOUT,
+                                   **kwargs)
+        except TypeError:
+            if not kwargs:
+                raise
+            log.warning('This MySQLdb does not support read_timeout and '
+                        'write_timeout, connections will wait forever on a '
+                        'hung server')
+            _io_timeouts_supported = False
+            conn = MySQLdb.connect(host=instance.hostname,
+                                   port=instance.port,
+                                   user=username,
+                                   passwd=password,
+                                   cursorclass=MySQLdb.cursors.DictCursor,
+                                   connect_timeout=CONNECT_TIMEOUT)
+    except MySQLdb.OperationalError as detail:
+        if (breaker is not None and detail.args and
+                detail.args[0] in MYSQL_UNREACHABLE_ERRORS):
+            breaker.record_failure(instance)
+        raise
+    if breaker is not None:
+        breaker.record_success(instance)
+    return conn
+
+
+def set_io_timeouts(read_timeout=None, write_timeout=None):
+    """ Set socket read and write timeouts for connections opened from now
+        on. With a MySQLdb which does not support read_timeout and
+        write_timeout, such as MySQL-python 1.2.5, they are ignored after
+        a warning.
+
+    Args:
+    read_timeout - Seconds to wait for a read, or None to wait forever
+    write_timeout - Seconds to wait for a write, or None to wait forever
+    """
+    global READ_TIMEOUT, WRITE_TIMEOUT
+    READ_TIMEOUT = read_timeout
+    WRITE_TIMEOUT = write_timeout
+
+
+class CircuitBreaker(object):
+    """ Track consecutive connection failures by instance, and refuse to
+        connect to an instance which has failed too often until it has had
+        time to recover.
+    """
+
+    def __init__(self, threshold=CIRCUIT_BREAKER_THRESHOLD,
+                 cooldown=CIRCUIT_BREAKER_COOLDOWN):
+        """
+        Args:
+        threshold - Consecutive failures after which an instance is skipped
+        cooldown - Seconds to skip an instance for
+        """
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.lock = threading.Lock()
+        # (hostname, port) -> [consecutive failures, skip until]
+        self.failures = dict()
+
+    def is_open(self, instance):
+        """ Check if connections to an instance are currently being skipped
+
+        Args:
+        instance - A hostaddr object
+
+        Returns:
+        True if the instance should not be connected to
+        """
+        entry = self.failures.get((instance.hostname, instance.port))
+        return entry is not None and time.time() < entry[1]
+
+    def check(self, instance):
+        """ Raise if connections to an instance are currently being skipped
+
+        Args:
+        instance - A hostaddr object
+        """
+        if self.is_open(instance):
+            raise InstanceUnreachable(MYSQL_ERROR_CONN_HOST_ERROR,
+                                      'Not connecting to {i}, it failed {num} '
+                                      'times in a row'.format(
+                                          i=instance,
+                                          num=self.threshold))
+
+    def record_failure(self, instance):
+        """ Record a failure to connect to an instance
+
+        Args:
+        instance - A hostaddr object
+        """
+        key = (instance.hostname, instance.port)
+        with self.lock:
+            entry = self.failures.setdefault(key, [0, 0])
+            entry[0] += 1
+            if entry[0] >= self.threshold:
+                # Once cooled down, a single further failure reopens it
+                entry[0] = self.threshold - 1
+                entry[1] = time.time() + self.cooldown
+                log.warning('{i} failed {num} times in a row, not connecting '
+                            'to it for {cooldown} seconds'.format(
+                                i=instance,
+                                num=self.threshold,
+                                cooldown=self.cooldown))
+
+    def record_success(self, instance):
+        """ Record a successful connection to an instance
+
+        Args:
+        instance - A hostaddr object
+        """
+        if (instance.hostname, instance.port) in self.failures:
+            with self.lock:
+                self.failures.pop((instance.hostname, instance.port), None)
+
+    def reset(self):
+        """ Forget all failures """
+        with self.lock:
+            self.failures = dict()
+
+
+def enable_circuit_breaker(threshold=CIRCUIT_BREAKER_THRESHOLD,
+                           cooldown=CIRCUIT_BREAKER_COOLDOWN):
+    """ Make new_mysql_connection and run_on_instances skip instances which
+        repeatedly fail to connect, for the rest of the process
+
+    Args:
+    threshold - Consecutive failures after which an instance is skipped
+    cooldown - Seconds to skip an instance for
+
+    Returns:
+    The CircuitBreaker object
+    """
+    global _circuit_breaker
+    if _circuit_breaker is None:
+        _circuit_breaker = CircuitBreaker(threshold, cooldown)
+    return _circuit_breaker
+
+
+def disable_circuit_breaker():
+    """ Stop skipping instances which repeatedly fail to connect """
+    global _circuit_breaker
+    _circuit_breaker = None
+
+
+class PooledConnection(object):
+    """ A MySQL connection checked out of a ConnectionPool. Only one caller
+        holds a checked out connection at a time. close(), or dropping the
+        last reference, returns the connection to the pool rather than
+        closing it. Everything else is passed through to the underlying
+        MySQLdb connection.
+    """
+
+    def __init__(self, pool, key, conn):
+        """
+        Args:
+        pool - The ConnectionPool the connection came from
+        key - The pool key of the connection
+        conn - A MySQLdb connection
+        """
+        object.__setattr__(self, '_pool', pool)
+        object.__setattr__(self, '_key', key)
+        object.__setattr__(self, '_conn', conn)
+
+    def __getattr__(self, name):
+        conn = self.__dict__.get('_conn')
+        if conn is None:
+            raise MySQLdb.InterfaceError(0, 'Connection has been returned '
+                                            'to the pool')
+        return getattr(conn, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._conn, name, value)
+
+    def close(self):
+        """ Return the connection to the pool """
+        conn = self.__dict__.get('_conn')
+        if conn is None:
+            return
+        object.__setattr__(self, '_conn', None)
+        self._pool.release(self._key, conn)
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            # Likely the interpreter is shutting down
+            pass
+
+
+class ConnectionPool(object):
+    """ Reuse MySQL connections keyed by (hostname, port, role).
+
+    A connection is checked out to one caller at a time and is rolled back
+    when it is returned, so uncommitted writes are never seen by the next
+    caller. Session state (ie SQL_LOG_BIN=0) is not reset, so callers must
+    not leave any behind.
+    """
+
+    def __init__(self, max_idle=POOL_MAX_IDLE_SECONDS,
+                 max_per_host=POOL_MAX_PER_HOST):
+        """
+        Args:
+        max_idle - Seconds a connection may sit unused before it is
+                   reopened rather than reused
+        max_per_host - Max idle connections to keep per instance
+        """
+        self.max_idle = max_idle
+        self.max_per_host = max_per_host
+        # Reentrant, as a garbage collected PooledConnection may be returned
+        # to the pool from any point, including while the lock is held
+        self.lock = threading.RLock()
+        # (hostname, port, role, read timeout, write timeout) ->
+        # [(connection, returned at), ...]
+        self.idle = dict()
+
+    def get_connection(self, instance, role):
+        """ Check out a healthy connection from the pool, or open a new one
+
+        Args:
+        instance - A hostaddr object
+        role - a string of the name of the mysql role to use
+
+        Returns:
+        A PooledConnection object
+        """
+        # Connections opened with different io timeouts are not interchangeable
+        key = (instance.hostname, instance.port, role, READ_TIMEOUT,
+               WRITE_TIMEOUT)
+        while True:
+            with self.lock:
+                idle = self.idle.get(key)
+                if not idle:
+                    break
+                (conn, returned) = idle.pop()
+            if time.time() - returned <= self.max_idle and self.check(conn):
+                return PooledConnection(self, key, conn)
+            self.close(conn)
+
+        return PooledConnection(self, key,
+                                new_mysql_connection(instance, role))
+
+    def release(self, key, conn):
+        """ Take back a checked out connection. It is rolled back, and
+            closed if it is unhealthy or the pool for its instance is full.
+
+        Args:
+        key - The pool key of the connection
+        conn - A MySQLdb connection
+        """
+        if not self.check(conn):
+            self.close(conn)
+            return
+
+        with self.lock:
+            idle = self.idle.setdefault(key, list())
+            if len(idle) < self.max_per_host:
+                idle.append((conn, time.time()))
+                return
+        self.close(conn)
+
+    def check(self, conn):
+        """ Health check a connection. The rollback also ends any
+            transaction left open, which would otherwise hold locks and
+            pin a stale REPEATABLE READ snapshot while idle.
+
+        Args:
+        conn - A MySQLdb connection
+
+        Returns:
+        True if the connection is usable
+        """
+        try:
+            conn.rollback()
+        except MySQLdb.Error:
+            return False
+        return True
+
+    def close(self, conn):
+        """ Close a connection, ignoring errors
+
+        Args:
+        conn - A MySQLdb connection
+        """
+        try:
+            conn.close()
+        except MySQLdb.Error:
+            pass
+
+    def close_all(self):
+        """ Close every idle connection. Checked out connections are closed
+            when they are returned.
+        """
+        with self.lock:
+            idle = self.idle
+            self.idle = dict()
+            # Anything returned from now on is over the limit and is closed
+            self.max_per_host = 0
+        for entries in idle.values():
+            for (conn, _) in entries:
+                self.close(conn)
+
+
+def enable_connection_pool(max_idle=POOL_MAX_IDLE_SECONDS,
+                           max_per_host=POOL_MAX_PER_HOST):
+    """ Make connect_mysql reuse connections for the rest of the process
+
+    Args:
+    max_idle - Seconds a connection may sit unused before it is reopened
+    max_per_host - Max connections to pool per instance
+
+    Returns:
+    The ConnectionPool object
+    """
+    global _connection_pool
+    if _connection_pool is None:
+        _connection_pool = ConnectionPool(max_idle, max_per_host)
+    return _connection_pool
+
+
+def disable_connection_pool():
+    """ Stop pooling connections and close all pooled connections """
+    global _connection_pool
+    pool = _connection_pool
+    _connection_pool = None
+    if pool is not None:
+        pool.close_all()
+
+
+def run_on_instances(instances, func, max_workers=FLEET_MAX_WORKERS,
+                     host_timeout=FLEET_HOST_TIMEOUT, timeout=FLEET_TIMEOUT):
+    """ Run a function against many MySQL instances concurrently
+
+    Each instance is worked on in its own thread, with at most max_workers
+    threads running at once. An instance which raises or runs past its
+    deadline does not stop work on the others. If the circuit breaker is
+    enabled, instances which recently failed to connect repeatedly are
+    skipped and reported as InstanceUnreachable. Threads can not be killed, so
+    an instance which times out is abandoned rather than interrupted and its
+    eventual result is discarded. An abandoned thread still counts against
+    max_workers until it finishes.
+
+    Args:
+    instances - An iterable of hostaddr objects
+    func - A function taking a hostaddr object as its only argument
+    max_workers - Max number of instances to work on at once
+    host_timeout - Seconds allowed for func to complete for one instance
+    timeout - Seconds allowed for the entire run. Instances which have not
+              completed by then fail with FleetTimeout, including any which
+              were never started.
+
+    Returns:
+    results - A dict keyed by hostaddr of the return value of func
+    errors - A dict keyed by hostaddr of the exception raised by func
+    """
+    deadline = time.time() + timeout
+    breaker = _circuit_breaker
+    pending = list(set(instances))
+    pending.reverse()
+    # hostaddr -> time the instance must be done by
+    running = dict()
+    # Instances which timed out but whose threads are still working. They
+    # count against max_workers until their threads finish.
+    abandoned = set()
+    finished = Queue.Queue()
+    results = dict()
+    errors = dict()
+
+    def worker(instance):
+        try:
+            finished.put((instance, True, func(instance)))
+        except Exception as e:
+            finished.put((instance, False, e))
+
+    while running or (pending and time.time() < deadline):
+        now = time.time()
+        while (pending and len(running) + len(abandoned) < max_workers and
+               now < deadline):
+            instance = pending.pop()
+            if breaker is not None and breaker.is_open(instance):
+                errors[instance] = InstanceUnreachable(
+                    MYSQL_ERROR_CONN_HOST_ERROR,
+                    '{i} is unreachable'.format(i=instance))
+                continue
+            running[instance] = min(now + host_timeout, deadline)
+            t = threading.Thread(target=worker, args=(instance,),
+                                 name='run_on_instances {i}'.format(i=instance))
+            t.daemon = True
+            t.start()
+
+        if not running and not (pending and abandoned):
+            break
+
+        try:
+            if running:
+                wait = max(min(running.values()) - time.time(), 0)
+            else:
+                # Only abandoned threads are holding up pending instances
+                wait = max(deadline - time.time(), 0)
+            (instance, success, value) = finished.get(timeout=wait)
+        except Queue.Empty:
+            pass
+        else:
+            # Results from instances which already timed out are dropped
+            if running.pop(instance, None) is not None:
+                if success:
+                    results[instance] = value
+                else:
+                    errors[instance] = value
+            else:
+                abandoned.discard(instance)
+
+        now = time.time()
+        for instance in [i for i in running if running[i] <= now]:
+            del running[instance]
+            abandoned.add(instance)
+            errors[instance] = FleetTimeout('{i} did not complete within its '
+                                            'deadline'.format(i=instance))
+
+    for instance in pending:
+        errors[instance] = FleetTimeout('{i} was not started before the '
+                                        'fleet deadline'.format(i=instance))
+    return results, errors
+
+
+class TimedCursorMixin(object):
+    """ Record the latency of every statement run on a cursor with
+        _query_stats. Only used by connect_mysql while query stats are
+        enabled, see get_timed_cursor_class().
+    """
+
+    # Set while a statement is being timed, so that the execute calls
+    # MySQLdb makes from executemany are not counted again
+    _timing = False
+
+    def execute(self, query, args=None):
+        return self._run_timed(super(TimedCursorMixin, self).execute,
+                               query, args)
+
+    def executemany(self, query, args):
+        return self._run_timed(super(TimedCursorMixin, self).executemany,
+                               query, args)
+
+    def callproc(self, procname, args=()):
+        return self._run_timed(super(TimedCursorMixin, self).callproc,
+                               procname, args)
+
+    def _run_timed(self, method, query, args):
+        """ Run a cursor method and record how long it took
+
+        Args:
+        method - The method of the underlying cursor class
+        query - The statement or procedure name
+        args - Arguments for the statement
+
+        Returns:
+        Whatever method returns
+        """
+        if self._timing:
+            return method(query, args)
+
+        self._timing = True
+        start = time.time()
+        success = False
+        try:
+            ret = method(query, args)
+            success = True
+            return ret
+        finally:
+            self._timing = False
+            if _query_stats is not None:
+                self.query_finished({'host': getattr(self.connection,
+                                                     'query_stats_host', None),
+                                     'function': get_query_caller(),
+                                     'query': query,
+                                     'latency': time.time() - start,
+                                     'rows': self.rowcount,
+                                     'success': success})
+
+    def query_finished(self, query):
+        """ Record a query which has been run
+
+        Args:
+        query - A dict of the arguments to QueryStats.record
+        """
+        stats = _query_stats
+        if stats is not None:
+            stats.record(**query)
+
+
+class TimedStreamingCursorMixin(TimedCursorMixin):
+    """ As the row count of a server side cursor is not known until all
+        rows have been read, a query is recorded when the cursor is closed,
+        with the number of rows fetched.
+    """
+
+    _pending_query = None
+    _streamed_rows = 0
+
+    def query_finished(self, query):
+        self.record_pending_query()
+        if not query['success']:
+            super(TimedStreamingCursorMixin, self).query_finished(query)
+            return
+        self._pending_query = query
+        self._streamed_rows = 0
+
+    def record_pending_query(self):
+        """ Record the query in progress, if any, with the rows fetched """
+        query = self._pending_query
+        if query is None:
+            return
+        self._pending_query = None
+        query['rows'] = self._streamed_rows
+        super(TimedStreamingCursorMixin, self).query_finished(query)
+
+    def fetchone(self):
+        row = super(TimedStreamingCursorMixin, self).fetchone()
+        if row is not None:
+            self._streamed_rows += 1
+        return row
+
+    def fetchmany(self, size=None):
+        rows = super(TimedStreamingCursorMixin, self).fetchmany(size)
+        self._streamed_rows += len(rows)
+        return rows
+
+    def fetchall(self):
+        rows = super(TimedStreamingCursorMixin, self).fetchall()
+        self._streamed_rows += len(rows)
+        return rows
+
+    def close(self):
+        try:
+            super(TimedStreamingCursorMixin, self).close()
+        finally:
+            self.record_pending_query()
+
+
+class TimedDictCursor(TimedCursorMixin, MySQLdb.cursors.DictCursor):
+    pass
+
+
+class TimedSSDictCursor(TimedStreamingCursorMixin,
+                        MySQLdb.cursors.SSDictCursor):
+    pass
+
+
+def get_timed_cursor_class(cursorclass):
+    """ Get a version of a cursor class which records query stats
+
+    Args:
+    cursorclass - A MySQLdb cursor class
+
+    Returns:
+    A subclass of cursorclass and TimedCursorMixin
+    """
+    if issubclass(cursorclass, TimedCursorMixin):
+        return cursorclass
+    if not _timed_cursor_classes:
+        _timed_cursor_classes[MySQLdb.cursors.DictCursor] = TimedDictCursor
+        _timed_cursor_classes[MySQLdb.cursors.SSDictCursor] = TimedSSDictCursor
+    timed = _timed_cursor_classes.get(cursorclass)
+    if timed is None:
+        if issubclass(cursorclass, MySQLdb.cursors.CursorUseResultMixIn):
+            mixin = TimedStreamingCursorMixin
+        else:
+            mixin = TimedCursorMixin
+        timed = type('Timed' + cursorclass.__name__, (mixin, cursorclass),
+                     dict())
+        _timed_cursor_classes[cursorclass] = timed
+    return timed
+
+
+def timed_cursor_method(cursor):
+    """ Wrap the cursor method of a connection, so that cursors of any
+        class it is asked for record query stats
+
+    Args:
+    cursor - The cursor method of a MySQLdb connection
+
+    Returns:
+    A replacement for the cursor method
+    """
+    if getattr(cursor, 'timed', False):
+        return cursor
+
+    def timed_cursor(cursorclass=None):
+        if cursorclass is None:
+            return cursor()
+        return cursor(get_timed_cursor_class(cursorclass))
+    timed_cursor.timed = True
+    return timed_cursor
+
+
+def get_query_caller():
+    """ Find the function a query is being run on behalf of, skipping
+        MySQLdb and the generic helpers in this module which run queries
+        for other functions
+
+    Returns:
+    A string of the module, class (if any) and function name
+    """
+    # Skip this function, TimedCursorMixin._run_timed and the cursor method
+    # which called it
+    frame = sys._getframe(3)
+    while frame.f_back is not None:
+        module = frame.f_globals.get('__name__', '?')
+        if module.startswith('MySQLdb') or (frame.f_globals is globals() and
+                                            frame.f_code.co_name in
+                                            QUERY_STATS_SKIP_FUNCTIONS):
+            frame = frame.f_back
+        else:
+            break
+
+    names = [frame.f_globals.get('__name__', '?')]
+    code = frame.f_code
+    if code.co_argcount and code.co_varnames[0] == 'self':
+        instance = frame.f_locals.get('self')
+        if instance is not None:
+            names.append(type(instance).__name__)
+    names.append(code.co_name)
+    return '.'.join(names)
+
+
+class QueryStats(object):
+    """ Latency histograms of the queries run by a process, by calling
+        function, and optionally a trace of every query.
+    """
+
+    def __init__(self, trace_file=None):
+        """
+        Args:
+        trace_file - If supplied, a path to write a JSON trace of every query
+                     to by write_trace
+        """
+        self.trace_file = trace_file
+        self.lock = threading.Lock()
+        # function -> {'count', 'errors', 'rows', 'total', 'max',
+        #              'histogram'}
+        self.functions = dict()
+        self.trace = list()
+
+    def record(self, host, function, query, latency, rows, success):
+        """ Record a single query
+
+        Args:
+        host - A string of the instance the query was run on
+        function - A string of the module and name of the function which
+                   ran the query
+        query - The query, before parameters were substituted
+        latency - Seconds the query took
+        rows - Number of rows affected or returned, -1 if unknown
+        success - False if the query raised an exception
+        """
+        bucket = bisect.bisect_left(QUERY_LATENCY_BUCKETS, latency)
+        with self.lock:
+            if function not in self.functions:
+                self.functions[function] = {
+                    'count': 0, 'errors': 0, 'rows': 0, 'total': 0.0,
+                    'max': 0.0,
+                    'histogram': [0] * (len(QUERY_LATENCY_BUCKETS) + 1)}
+            entry = self.functions[function]
+            entry['count'] += 1
+            if not success:
+                entry['errors'] += 1
+            if rows > 0:
+                entry['rows'] += rows
+            entry['total'] += latency
+            entry['max'] = max(entry['max'], latency)
+            entry['histogram'][bucket] += 1
+
+            if self.trace_file and len(self.trace) < QUERY_TRACE_MAX:
+                self.trace.append({'time': time.time() - latency,
+                                   'host': host,
+                                   'function': function,
+                                   'query': query,
+                                   'latency': latency,
+                                   'rows': rows,
+                                   'success': success})
+
+    def percentile(self, function, percent):
+        """ Estimate a latency percentile from a histogram
+
+        Args:
+        function - A function name, as passed to record
+        percent - A number between 0 and 100
+
+        Returns:
+        The upper bound in seconds of the histogram bucket holding the
+        percentile. Latencies past the last bucket are reported as the max
+        latency seen.
+        """
+        entry = self.functions[function]
+        target = entry['count'] * percent / 100.0
+        seen = 0
+        for (bucket, count) in enumerate(entry['histogram']):
+            seen += count
+            if count and seen >= target:
+                if bucket < len(QUERY_LATENCY_BUCKETS):
+                    return min(QUERY_LATENCY_BUCKETS[bucket], entry['max'])
+                break
+        return entry['max']
+
+    def summary(self):
+        """ Describe where time was spent, slowest functions first
+
+        Returns:
+        A string
+        """
+        with self.lock:
+            functions = sorted(self.functions,
+                               key=lambda f: self.functions[f]['total'],
+                               reverse=True)
+            lines = ['{func:<60} {count:>7} {errors:>6} {total:>9} '
+                     '{p50:>8} {p95:>8} {max:>8}'.format(func='function',
+                                                         count='queries',
+                                                         errors='errors',
+                                                         total='total_s',
+                                                         p50='p50_s',
+                                                         p95='p95_s',
+                                                         max='max_s')]
+            for function in functions:
+                entry = self.functions[function]
+                lines.append('{func:<60} {count:>7} {errors:>6} '
+                             '{total:>9.3f} {p50:>8.3f} {p95:>8.3f} '
+                             '{max:>8.3f}'.format(
+                                 func=function,
+                                 count=entry['count'],
+                                 errors=entry['errors'],
+                                 total=entry['total'],
+                                 p50=self.percentile(function, 50),
+                                 p95=self.percentile(function, 95),
+                                 max=entry['max']))
+        return '\n'.join(lines)
+
+    def write_trace(self):
+        """ Write the histograms and the trace of every query to trace_file
+            as JSON
+        """
+        with self.lock:
+            data = {'buckets': QUERY_LATENCY_BUCKETS,
+                    'functions': self.functions,
+                    'queries': self.trace}
+            with open(self.trace_file, 'w') as f:
+                json.dump(data, f)
+
+    def report(self):
+        """ Log a summary and write the trace, if one was requested """
+        if self.functions:
+            log.info('Query stats:\n{summary}'.format(summary=self.summary()))
+        if self.trace_file:
+            try:
+                self.write_trace()
+            except (IOError, OSError) as e:
+                log.error('Could not write query trace: {e}'.format(e=e))
+
+
+def enable_query_stats(trace_file=None):
+    """ Time every query run on connections from connect_mysql for the rest
+        of the process and report on them at exit. Connections obtained
+        before this is called are not timed until they are fetched again
+        from connect_mysql.
+
+    Args:
+    trace_file - If supplied, a path to write a JSON trace of every query to
+
+    Returns:
+    The QueryStats object
+    """
+    global _query_stats
+    if _query_stats is None:
+        _query_stats = QueryStats(trace_file)
+        atexit.register(_query_stats.report)
+    return _query_stats
+
+
+def disable_query_stats():
+    """ Stop timing queries
+
+    Returns:
+    The QueryStats object which was in use, if any
+    """
+    global _query_stats
+    stats = _query_stats
+    _query_stats = None
+    return stats
+
+
 def get_master_from_instance(instance):
     """ Determine if an instance thinks it is a slave and if so from where
 
@@ -266,6 +1211,91 @@ def get_master_status(conn):
     return master_status
 
 
+def master_pos_wait(replica, log_file, log_pos, timeout, conn=None):
+    """ Block until a replica has executed up to a position in the binlogs of
+        its master, using MASTER_POS_WAIT so that we return the moment it
+        gets there.
+
+    Args:
+    replica - A hostaddr object
+    log_file - The name of a binlog on the master
+    log_pos - A position in log_file
+    timeout - Max seconds to wait
+    conn - Optionally, a connection to replica to wait on, which is left
+           open. Its read timeout, if any, must be longer than timeout.
+
+    Returns:
+    True if the replica reached the position, False if timeout was reached
+    """
+    # A timeout of 0 or less means wait forever
+    params = {'log_file': log_file,
+              'log_pos': log_pos,
+              'timeout': max(int(math.ceil(timeout)), 1)}
+    if conn is not None:
+        own_conn = False
+    elif READ_TIMEOUT is not None and READ_TIMEOUT <= params['timeout']:
+        # Nothing is sent back until the wait is over, so the socket must
+        # be willing to wait longer than that
+        own_conn = True
+        conn = new_mysql_connection(replica,
+                                    read_timeout=params['timeout'] +
+                                    READ_TIMEOUT)
+    else:
+        own_conn = True
+        conn = connect_mysql(replica)
+    try:
+        cursor = conn.cursor()
+        cursor.execute('SELECT MASTER_POS_WAIT(%(log_file)s, %(log_pos)s, '
+                       '%(timeout)s) AS events', params)
+        events = cursor.fetchone()['events']
+    finally:
+        if own_conn:
+            conn.close()
+    if events is None:
+        raise ReplicationError('SQL thread on {replica} is not running or '
+                               'replication is not configured'
+                               ''.format(replica=replica))
+    return events >= 0
+
+
+def wait_for_master_pos(master, replicas, timeout):
+    """ Wait for replicas to execute everything written to a master so far.
+        The master position is read once, then all replicas are waited on
+        at the same time.
+
+    Args:
+    master - A hostaddr object for the master
+    replicas - A set of hostaddr objects replicating directly from master
+    timeout - Max seconds to wait
+
+    Returns:
+    A dict from get_master_status of the position waited for
+    """
+    master_status = get_master_status(connect_mysql(master))
+    log.info('Waiting for {replicas} to reach {log_file}:{log_pos} on '
+             '{master}'.format(replicas=', '.join(str(r) for r in replicas),
+                               log_file=master_status['File'],
+                               log_pos=master_status['Position'],
+                               master=master))
+    (reached, errors) = run_on_instances(
+        replicas,
+        lambda r: master_pos_wait(r, master_status['File'],
+                                  master_status['Position'], timeout),
+        host_timeout=timeout + CONNECT_TIMEOUT + 1,
+        timeout=timeout + CONNECT_TIMEOUT + 1)
+
+    for replica in reached:
+        if not reached[replica]:
+            errors[replica] = ReplicationError('Timed out after {timeout} '
+                                               'seconds'.format(timeout=timeout))
+    if errors:
+        raise ReplicationError('Replicas did not reach {log_file}:{log_pos}: '
+                               '{errors}'.format(log_file=master_status['File'],
+                                                 log_pos=master_status['Position'],
+                                                 errors=errors))
+    return master_status
+
+
 def get_master_logs(conn):
     """ Get MySQL binary log names and size
 
@@ -294,45 +1324,140 @@ def get_master_logs(conn):
     return master_status
 
 
+def get_binlog_num(log_name):
+    """ Get the number of a binlog from its name
+
+    Args:
+    log_name - A binlog name, ie 'mysql-bin.000281'
+
+    Returns:
+    An int, ie 281
+    """
+    return int(log_name.rsplit('.', 1)[1])
+
+
+class BinlogIndex(object):
+    """ The binlogs of a master, indexed so that the bytes between any
+        position and the end of the newest binlog can be found with a bisect
+        and a subtraction. One index can be shared by every replica of the
+        master it was built from.
+
+    Attributes:
+    nums - A sorted list of binlog numbers
+    offsets - A list, the total size of all binlogs before the binlog at the
+              same index in nums, followed by the total size of all binlogs
+    """
+
+    def __init__(self, master_logs):
+        """
+        Args:
+        master_logs - A tuple of dicts from get_master_logs
+        """
+        logs = sorted((get_binlog_num(binlog['Log_name']), binlog['File_size'])
+                      for binlog in master_logs)
+        self.nums = list()
+        self.offsets = [0]
+        for (num, size) in logs:
+            self.nums.append(num)
+            self.offsets.append(self.offsets[-1] + size)
+
+    def behind(self, log_file_num, log_file_pos):
+        """ Calculate how far a position is behind the end of the binlogs
+
+        Args:
+        log_file_num - The number of the binlog, as an int or a string
+        log_file_pos - The position inside of log_file_num
+
+        Returns:
+        bytes_behind - bytes of lag across all log file
+        binlogs_behind - number of binlogs lagged
+        """
+        log_file_num = int(log_file_num)
+        i = bisect.bisect_left(self.nums, log_file_num)
+        binlogs_behind = len(self.nums) - i
+        bytes_behind = self.offsets[-1] - self.offsets[i]
+        if i < len(self.nums) and self.nums[i] == log_file_num:
+            binlogs_behind -= 1
+            bytes_behind -= log_file_pos
+        # A position written after the index was built is not behind
+        return max(bytes_behind, 0), binlogs_behind
+
+    def is_past_end(self, log_file_num, log_file_pos):
+        """ Check if a position was written after the index was built
+
+        Args:
+        log_file_num - The number of the binlog, as an int or a string
+        log_file_pos - The position inside of log_file_num
+
+        Returns:
+        True if the position is past the end of the newest binlog
+        """
+        if not self.nums:
+            return True
+        log_file_num = int(log_file_num)
+        if log_file_num != self.nums[-1]:
+            return log_file_num > self.nums[-1]
+        return log_file_pos > self.offsets[-1] - self.offsets[-2]
+
+
+def get_binlog_index(conn):
+    """ Get the binlogs of a master as a BinlogIndex
+
+    Args:
+    conn - a connection to the master
+
+    Returns:
+    A BinlogIndex object
+    """
+    return BinlogIndex(get_master_logs(conn))
+
+
 def calc_binlog_behind(log_file_num, log_file_pos, master_logs):
     """ Calculate replication lag in bytes
 
     Args:
     log_file_num - The integer of the binlog
     log_file_pos - The position inside of log_file_num
-    master_logs - A tuple of dicts describing the replication status
+    master_logs - A BinlogIndex object, or a tuple of dicts describing the
+                  replication status
 
     Returns:
     bytes_behind - bytes of lag across all log file
     binlogs_behind - number of binlogs lagged
     """
+    if not isinstance(master_logs, BinlogIndex):
+        master_logs = BinlogIndex(master_logs)
+    return master_logs.behind(log_file_num, log_file_pos)
 
-    binlogs_behind = 0
-    bytes_behind = 0
-    for binlog in master_logs:
-        _, binlog_num = re.split('\.', binlog['Log_name'])
-        if binlog_num >= log_file_num:
-            if binlog_num == log_file_num:
-                bytes_behind += binlog['File_size'] - log_file_pos
-            else:
-                binlogs_behind += 1
-                bytes_behind += binlog['File_size']
-    return bytes_behind, binlogs_behind
 
-
-def get_global_variables(conn):
+def get_global_variables(conn, variables=None):
     """ Get MySQL global variables
 
     Args:
     conn - a connection to the MySQL instance
+    variables - If supplied, a list of the names of the only variables to
+                fetch
 
     Returns:
-    A dict with the key the variable name
+    A dict with the key the variable name. Variables which do not exist on
+    the server are not included.
     """
 
     ret = dict()
+    if variables is not None and not variables:
+        return ret
+
     cursor = conn.cursor()
-    cursor.execute("SHOW GLOBAL VARIABLES")
+    if variables is None:
+        cursor.execute("SHOW GLOBAL VARIABLES")
+    else:
+        params = dict()
+        for variable in variables:
+            params['var{num}'.format(num=len(params))] = variable
+        sql = ''.join(("SHOW GLOBAL VARIABLES WHERE Variable_name IN (",
+                       ', '.join('%({p})s'.format(p=p) for p in params),
+                       ")"))
+        cursor.execute(sql, params)
     list_variables = cursor.fetchall()
     for entry in list_variables:
         ret[entry['Variable_name']] = entry['Value']
@@ -340,6 +1465,101 @@ def get_global_variables(conn):
     return ret
 
 
+def get_cached_global_variables(conn, variables, ttl=GLOBAL_VARIABLES_TTL):
+    """ Get MySQL global variables, reusing values previously fetched on the
+        same connection. Any variables not cached are fetched in a single
+        query. Changes made through set_global_variable are seen at once,
+        changes made by other clients may take up to ttl seconds.
+
+    Args:
+    conn - a connection to the MySQL instance
+    variables - A list of variable names
+    ttl - Max age in seconds of a cached value to return
+
+    Returns:
+    A dict with the key the variable name. Variables which do not exist on
+    the server are not included.
+    """
+    cache = _global_variables.setdefault(conn, dict())
+    now = time.time()
+    missing = [variable for variable in variables
+               if variable not in cache or
+               not 0 <= now - cache[variable][1] < ttl]
+    if missing:
+        fetched = get_global_variables(conn, missing)
+        for variable in missing:
+            # Also cache that a variable does not exist on this server
+            cache[variable] = (fetched.get(variable), now)
+
+    ret = dict()
+    for variable in variables:
+        if cache[variable][0] is not None:
+            ret[variable] = cache[variable][0]
+    return ret
+
+
+def invalidate_global_variables(conn):
+    """ Forget the cached global variables of a connection
+
+    Args:
+    conn - a connection to the MySQL instance
+    """
+    _global_variables.pop(conn, None)
+
+
+def stream_query(conn, sql, params=None, fetch_size=STREAM_FETCH_SIZE):
+    """ Run a query and yield its rows as they arrive from the server rather
+        than buffering the entire result set client side.
+
+    No other query may be run on the connection until the generator has been
+    exhausted or closed.
+
+    Args:
+    conn - a connection to the MySQL instance
+    sql - the query to run
+    params - parameters for the query
+    fetch_size - number of rows to fetch from the server at a time
+
+    Returns:
+    A generator of rows as dicts
+    """
+    if _query_stats is not None:
+        cursor = conn.cursor(TimedSSDictCursor)
+    else:
+        cursor = conn.cursor(MySQLdb.cursors.SSDictCursor)
+    try:
+        cursor.execute(sql, params)
+        while True:
+            rows = cursor.fetchmany(fetch_size)
+            if not rows:
+                break
+            for row in rows:
+                yield row
+    finally:
+        # Reads and discards any unread rows so the connection is usable
+        cursor.close()
+
+
+def query_rows(conn, sql, params=None, stream=False):
+    """ Run a query, buffering its result client side unless asked to stream
+
+    Args:
+    conn - a connection to the MySQL instance
+    sql - the query to run
+    params - parameters for the query
+    stream - If True, use stream_query. No other query may be run on the
+             connection until the rows have all been read.
+
+    Returns:
+    An iterable of rows as dicts
+    """
+    if stream:
+        return stream_query(conn, sql, params)
+    cursor = conn.cursor()
+    cursor.execute(sql, params)
+    return cursor.fetchall()
+
+
 def get_dbs(conn):
     """ Get MySQL databases other than mysql, information_schema,
     performance_schema and test
@@ -350,20 +1570,29 @@ def get_dbs(conn):
     Returns
     A set of databases
     """
+    return set(iter_dbs(conn, stream=False))
 
-    ret = set()
-    cursor = conn.cursor()
-    cursor.execute(' '.join(("SELECT schema_name",
-                             "FROM information_schema.schemata",
-                             "WHERE schema_name NOT IN('mysql',",
-                             "                         'information_schema',",
-                             "                         'performance_schema',",
-                             "                         'test')",
-                             "ORDER BY schema_name")))
-    dbs = cursor.fetchall()
-    for db in dbs:
-        ret.add(db['schema_name'])
-    return ret
+
+def iter_dbs(conn, stream=True):
+    """ Stream MySQL databases other than mysql, information_schema,
+    performance_schema and test
+
+    Args:
+    conn - a connection to the MySQL instance
+    stream - If False, fetch all rows before yielding any
+
+    Returns
+    A generator of database names, in order
+    """
+    sql = ' '.join(("SELECT schema_name",
+                    "FROM information_schema.schemata",
+                    "WHERE schema_name NOT IN('mysql',",
+                    "                         'information_schema',",
+                    "                         'performance_schema',",
+                    "                         'test')",
+                    "ORDER BY schema_name"))
+    for db in query_rows(conn, sql, stream=stream):
+        yield db['schema_name']
 
 
 def does_table_exist(conn, db, table):
@@ -409,21 +1638,140 @@ def get_tables(conn, db, skip_views=False):
     Returns
     A set of tables
     """
-    ret = set()
+    return set(iter_tables(conn, db, skip_views, stream=False))
+
+
+def iter_tables(conn, db, skip_views=False, stream=True):
+    """ Stream the tables and views in a given database or just tables
+
+    Args:
+    conn - a connection to the MySQL instance
+    db - a string which contains a name of a db
+    skip_views - true if we want tables only, false if we want everything
+    stream - If False, fetch all rows before yielding any
+
+    Returns
+    A generator of table names
+    """
     param = {'db': db}
-    cursor = conn.cursor()
     sql = ''.join(("SELECT TABLE_NAME ",
                    "FROM information_schema.tables ",
                    "WHERE TABLE_SCHEMA=%(db)s "))
     if skip_views:
         sql = sql + ' AND TABLE_TYPE="BASE TABLE" '
 
-    cursor.execute(sql, param)
-    tables = cursor.fetchall()
-    for table in tables:
-        ret.add(table['TABLE_NAME'])
+    for table in query_rows(conn, sql, param, stream=stream):
+        yield table['TABLE_NAME']
 
-    return ret
+
+class CatalogSnapshot(object):
+    """ The schemas and tables of a MySQL instance, fetched in bulk so that
+        questions about many dbs do not each need a round trip.
+
+    Attributes:
+    schemata - A set of all schema names, including system schemas
+    tables - A dict keyed by schema name of dicts keyed by table name of
+             TABLE_TYPE, ENGINE, TABLE_ROWS, DATA_LENGTH and INDEX_LENGTH
+    created_at - When the snapshot was taken
+    """
+
+    def __init__(self, conn):
+        """
+        Args:
+        conn - a connection to the MySQL instance
+        """
+        self.created_at = time.time()
+        self.schemata = set()
+        self.tables = dict()
+        sql = 'SELECT SCHEMA_NAME FROM information_schema.schemata'
+        for row in stream_query(conn, sql):
+            self.schemata.add(row['SCHEMA_NAME'])
+            self.tables[row['SCHEMA_NAME']] = dict()
+
+        sql = ("SELECT TABLE_SCHEMA, TABLE_NAME, TABLE_TYPE, ENGINE, "
+               "    TABLE_ROWS, DATA_LENGTH, INDEX_LENGTH "
+               "FROM information_schema.tables")
+        for row in stream_query(conn, sql):
+            db = row['TABLE_SCHEMA']
+            # A schema created between the two queries
+            if db not in self.tables:
+                self.schemata.add(db)
+                self.tables[db] = dict()
+            self.tables[db][row['TABLE_NAME']] = {
+                'TABLE_TYPE': row['TABLE_TYPE'],
+                'ENGINE': row['ENGINE'],
+                'TABLE_ROWS': row['TABLE_ROWS'],
+                'DATA_LENGTH': row['DATA_LENGTH'],
+                'INDEX_LENGTH': row['INDEX_LENGTH']}
+
+    def is_fresh(self, ttl=CATALOG_TTL):
+        """ Check if the snapshot was taken within ttl seconds
+
+        Args:
+        ttl - Max age of the snapshot in seconds
+
+        Returns:
+        True if the snapshot may still be used
+        """
+        return 0 <= time.time() - self.created_at < ttl
+
+    def get_dbs(self):
+        """ Same as mysql_lib.get_dbs """
+        return self.schemata.difference(SYSTEM_DBS)
+
+    def get_tables(self, db, skip_views=False):
+        """ Same as mysql_lib.get_tables """
+        tables = self.tables.get(db, dict())
+        if not skip_views:
+            return set(tables)
+        return set(table for table in tables
+                   if tables[table]['TABLE_TYPE'] == 'BASE TABLE')
+
+    def does_table_exist(self, db, table):
+        """ Same as mysql_lib.does_table_exist """
+        return table in self.tables.get(db, dict())
+
+    def get_table_info(self, db, table):
+        """ Get the type, engine, row count and sizes of a table
+
+        Args:
+        db - a string which contains a name of a db
+        table - the name of a table in db
+
+        Returns:
+        A dict of TABLE_TYPE, ENGINE, TABLE_ROWS, DATA_LENGTH and
+        INDEX_LENGTH, or None if the table does not exist. TABLE_ROWS is an
+        estimate for InnoDB tables.
+        """
+        return self.tables.get(db, dict()).get(table)
+
+
+def get_catalog(conn, ttl=CATALOG_TTL, refresh=False):
+    """ Get a snapshot of the schemas and tables on an instance. Snapshots
+        are cached per connection for ttl seconds.
+
+    Args:
+    conn - a connection to the MySQL instance
+    ttl - Max age in seconds of a cached snapshot to return
+    refresh - Ignore any cached snapshot
+
+    Returns:
+    A CatalogSnapshot object
+    """
+    catalog = _catalogs.get(conn)
+    if refresh or catalog is None or not catalog.is_fresh(ttl):
+        catalog = CatalogSnapshot(conn)
+        _catalogs[conn] = catalog
+    return catalog
+
+
+def invalidate_catalog(conn):
+    """ Forget the cached catalog snapshot of a connection
+
+    Args:
+    conn - a connection to the MySQL instance
+    """
+    _catalogs.pop(conn, None)
 
 
 def setup_semisync_plugins(instance):
@@ -436,7 +1784,7 @@ def setup_semisync_plugins(instance):
         instance - A hostaddr object
     """
     conn = connect_mysql(instance)
-    version = get_global_variables(conn)['version']
+    version = get_cached_global_variables(conn, ['version'])['version']
     if version[0:3] == '5.5':
         return
 
@@ -464,7 +1812,7 @@ def setup_response_time_metrics(instance):
     instance -  A hostaddr object
     """
     conn = connect_mysql(instance)
-    version = get_global_variables(conn)['version']
+    version = get_cached_global_variables(conn, ['version'])['version']
     if version[0:3] != '5.6':
         return
 
@@ -506,7 +1854,7 @@ def enable_and_flush_activity_statistics(conn):
     Args:
     conn - a connection to the MySQL instance
     """
-    global_vars = get_global_variables(conn)
+    global_vars = get_cached_global_variables(conn, ['userstat'])
     if global_vars['userstat'] != 'ON':
         set_global_variable(conn, 'userstat', True)
     cursor = conn.cursor()
@@ -529,15 +1877,26 @@ def get_dbs_activity(conn):
     Returns:
     A dict with a key of the db name and entries for rows read and rows changed
     """
-    global_vars = get_global_variables(conn)
+    return dict(iter_dbs_activity(conn, stream=False))
+
+
+def iter_dbs_activity(conn, stream=True):
+    """ Stream rows read and changed from a MySQL instance by db
+
+    Args:
+    conn - a connection to the MySQL instance
+    stream - If False, fetch all rows before yielding any
+
+    Returns:
+    A generator of tuples of the db name and a dict of rows read and rows
+    changed
+    """
+    global_vars = get_cached_global_variables(conn, ['userstat'])
     if global_vars['userstat'] != 'ON':
         raise InvalidVariableForOperation('Userstats must be enabled on ',
                                           'for table_statistics to function. '
                                           'Perhaps run "SET GLOBAL userstat = '
                                           'ON" to fix this.')
-    ret = dict()
-    cursor = conn.cursor()
-
     sql = ("SELECT SCHEMA_NAME, "
            "    SUM(ROWS_READ) AS 'ROWS_READ', "
            "    SUM(ROWS_CHANGED) AS 'ROWS_CHANGED' "
@@ -545,18 +1904,15 @@ def get_dbs_activity(conn):
            "LEFT JOIN information_schema.TABLE_STATISTICS "
            "    ON SCHEMA_NAME=TABLE_SCHEMA "
            "GROUP BY SCHEMA_NAME ")
-    cursor.execute(sql)
-    raw_activity = cursor.fetchall()
-    for row in raw_activity:
+    for row in query_rows(conn, sql, stream=stream):
         if row['ROWS_READ'] is None:
             row['ROWS_READ'] = 0
 
         if row['ROWS_CHANGED'] is None:
             row['ROWS_CHANGED'] = 0
 
-        ret[row['SCHEMA_NAME']] = {'ROWS_READ': int(row['ROWS_READ']),
-                                   'ROWS_CHANGED': int(row['ROWS_CHANGED'])}
-    return ret
+        yield (row['SCHEMA_NAME'], {'ROWS_READ': int(row['ROWS_READ']),
+                                    'ROWS_CHANGED': int(row['ROWS_CHANGED'])})
 
 
 def get_user_activity(conn):
@@ -568,24 +1924,30 @@ def get_user_activity(conn):
     Returns:
     a dict of user activity since last flush
     """
-    global_vars = get_global_variables(conn)
+    return dict(iter_user_activity(conn, stream=False))
+
+
+def iter_user_activity(conn, stream=True):
+    """ Stream information about activity broken down by mysql user account
+
+    Args:
+    conn - a connection to the MySQL instance
+    stream - If False, fetch all rows before yielding any
+
+    Returns:
+    A generator of tuples of the user and a dict of activity since last flush
+    """
+    global_vars = get_cached_global_variables(conn, ['userstat'])
     if global_vars['userstat'] != 'ON':
         raise InvalidVariableForOperation('Userstats must be enabled on ',
                                           'for table_statistics to function. '
                                           'Perhaps run "SET GLOBAL userstat = '
                                           'ON" to fix this.')
-    ret = dict()
-    cursor = conn.cursor()
-
     sql = 'SELECT * FROM information_schema.USER_STATISTICS'
-    cursor.execute(sql)
-    raw_activity = cursor.fetchall()
-    for row in raw_activity:
+    for row in query_rows(conn, sql, stream=stream):
         user = row['USER']
         del(row['USER'])
-        ret[user] = row
-
-    return ret
+        yield (user, row)
 
 
 def get_connected_users(conn):
@@ -656,6 +2018,7 @@ def create_db(conn, db):
     warnings.filterwarnings('ignore', category=MySQLdb.Warning)
     cursor.execute(sql)
     warnings.resetwarnings()
+    invalidate_catalog(conn)
 
 
 def copy_db_schema(conn, old_db, new_db, verbose=False, dry_run=False):
@@ -670,14 +2033,20 @@ def copy_db_schema(conn, old_db, new_db, verbose=False, dry_run=False):
     """
     cursor = conn.cursor()
     tables = get_tables(conn, old_db)
-    for table in tables:
-        raw_sql = "CREATE TABLE IF NOT EXISTS `{new_db}`.`{table}` LIKE `{old_db}`.`{table}`"
-        sql = raw_sql.format(old_db=old_db, new_db=new_db, table=table)
-        if verbose:
-            print sql
-
+    try:
+        for table in tables:
+            raw_sql = "CREATE TABLE IF NOT EXISTS `{new_db}`.`{table}` LIKE `{old_db}`.`{table}`"
+            sql = raw_sql.format(old_db=old_db, new_db=new_db, table=table)
+            if verbose:
+                print sql
+
+            if not dry_run:
+                cursor.execute(sql)
+    finally:
+        # Also after a failure part way through, as some tables may have
+        # been changed
         if not dry_run:
-            cursor.execute(sql)
+            invalidate_catalog(conn)
 
 
 def move_db_contents(conn, old_db, new_db, verbose=False, dry_run=False):
@@ -692,14 +2061,20 @@ def move_db_contents(conn, old_db, new_db, verbose=False, dry_run=False):
     """
     cursor = conn.cursor()
     tables = get_tables(conn, old_db)
-    for table in tables:
-        raw_sql = "RENAME TABLE `{old_db}`.`{table}` to `{new_db}`.`{table}`"
-        sql = raw_sql.format(old_db=old_db, new_db=new_db, table=table)
-        if verbose:
-            print sql
-
+    try:
+        for table in tables:
+            raw_sql = "RENAME TABLE `{old_db}`.`{table}` to `{new_db}`.`{table}`"
+            sql = raw_sql.format(old_db=old_db, new_db=new_db, table=table)
+            if verbose:
+                print sql
+
+            if not dry_run:
+                cursor.execute(sql)
+    finally:
+        # Also after a failure part way through, as some tables may have
+        # been changed
         if not dry_run:
-            cursor.execute(sql)
+            invalidate_catalog(conn)
 
 
 def setup_replication(new_master, new_replica):
@@ -807,65 +2182,223 @@ def change_master(slave_hostaddr, master_hostaddr, master_log_file,
             raise Exception("IO thread is not running")
 
 
-def wait_replication_catch_up(slave_hostaddr):
+class AdaptivePoller(object):
+    """ Decide when to next sample a value which should fall to a target,
+        such as replication lag, from how fast it has been falling.
+
+    The next sample is scheduled for about halfway to when the value is
+    expected to reach the target, so that polling is frequent when close and
+    rare when far away. If the value is not falling, the interval backs off
+    exponentially. Intervals are always between min_interval and
+    max_interval and never run past the deadline.
+    """
+
+    def __init__(self, target, min_interval, max_interval, timeout=None,
+                 smoothing=.5):
+        """
+        Args:
+        target - The value at or below which waiting is done
+        min_interval - Min seconds between samples
+        max_interval - Max seconds between samples
+        timeout - If supplied, seconds from now after which sleep raises
+                  PollTimeout
+        smoothing - Weight given to the newest rate observed, between 0
+                    and 1
+        """
+        self.target = target
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        if timeout is None:
+            self.deadline = None
+        else:
+            self.deadline = time.time() + timeout
+        self.smoothing = smoothing
+        # Amount the value falls per second, smoothed
+        self.rate = None
+        self.last = None
+        self.interval = min_interval
+
+    def record(self, value):
+        """ Record a sample of the value
+
+        Args:
+        value - The current value
+        """
+        now = time.time()
+        if self.last is not None and now > self.last[0]:
+            rate = float(self.last[1] - value) / (now - self.last[0])
+            if self.rate is None:
+                self.rate = rate
+            else:
+                self.rate = (self.smoothing * rate +
+                             (1 - self.smoothing) * self.rate)
+        self.last = (now, value)
+
+    def eta(self):
+        """ Estimate how long until the value reaches the target
+
+        Returns:
+        Seconds, float('inf') if the value is not falling, or None if there
+        are not yet enough samples to tell
+        """
+        if self.last is None:
+            return None
+        distance = self.last[1] - self.target
+        if distance <= 0:
+            return 0
+        if self.rate is None:
+            return None
+        if self.rate <= 0:
+            return float('inf')
+        return distance / self.rate
+
+    def next_interval(self):
+        """ Get how long to wait before the next sample
+
+        Returns:
+        Seconds to wait
+        """
+        eta = self.eta()
+        if eta is None or eta == float('inf'):
+            interval = self.interval * 2
+        else:
+            interval = eta / 2
+        self.interval = min(max(interval, self.min_interval),
+                            self.max_interval)
+        if self.deadline is not None:
+            return max(min(self.interval, self.deadline - time.time()), 0)
+        return self.interval
+
+    def expired(self):
+        """ Check if the deadline has passed
+
+        Returns:
+        True if there is a deadline and it has passed
+        """
+        return self.deadline is not None and time.time() >= self.deadline
+
+    def sleep(self):
+        """ Wait until the next sample is due
+
+        Raises PollTimeout if the deadline has already passed
+        """
+        if self.expired():
+            raise PollTimeout('Gave up waiting for {value} to reach '
+                              '{target}'.format(value=self.last[1],
+                                                target=self.target))
+        time.sleep(self.next_interval())
+
+
+def wait_replication_catch_up(slave_hostaddr, timeout=None):
     """ Watch replication until it is caught up
 
     Args:
     slave_hostaddr - A HostAddr object
+    timeout - If supplied, max seconds to wait before raising PollTimeout
     """
-    last_sbm = None
     catch_up_sbm = MAX_HEARTBEAT_LAG - HEARTBEAT_SAFETY_MARGIN
-    remaining_time = 'Not yet availible'
-    sleep_duration = 60
-    while True:
-        replication = calc_slave_lag(slave_hostaddr)
-        if replication['sql_bytes'] is None:
-            log.info(replication)
-            raise Exception("Could not compute replication lag")
-
-        if replication['ss']['Slave_IO_Running'] != 'Yes':
-            log.warning('IO thread is not running, going to sleep 15 '
-                        'seconds in case things get better on their own')
-            time.sleep(15)
+    poller = AdaptivePoller(catch_up_sbm,
+                            min_interval=REPLICATION_POLL_MIN_INTERVAL,
+                            max_interval=REPLICATION_POLL_MAX_INTERVAL,
+                            timeout=timeout)
+    # A connection to the replica kept open for MASTER_POS_WAIT, and the
+    # master and position being waited for. The position is only read
+    # again once the replica has reached it.
+    wait_conn = None
+    target = None
+    try:
+        while True:
             replication = calc_slave_lag(slave_hostaddr)
-            if replication['ss']['Slave_IO_Running'] != 'Yes':
-                raise Exception("IO thread is not running")
+            if replication['sql_bytes'] is None:
+                log.info(replication)
+                raise Exception("Could not compute replication lag")
 
-        if replication['ss']['Slave_SQL_Running'] != 'Yes':
-            raise Exception("SQL thread is not running")
-
-        if replication['sbm'] < catch_up_sbm:
-            log.info('Replication computed seconds behind master {sbm} < '
-                     '{catch_up_sbm}'.format(sbm=replication['sbm'],
-                                             catch_up_sbm=catch_up_sbm))
-            break
-        else:
-            if last_sbm:
-                catch_up_rate = (last_sbm - replication['sbm']) / sleep_duration
-                if catch_up_rate > 0:
-                    remaining_time = datetime.timedelta(seconds=((replication['sbm'] - catch_up_sbm) / catch_up_rate))
-                else:
-                    remaining_time = '> heat death of the universe'
+            if replication['ss']['Slave_IO_Running'] != 'Yes':
+                log.warning('IO thread is not running, going to sleep 15 '
+                            'seconds in case things get better on their own')
+                time.sleep(15)
+                replication = calc_slave_lag(slave_hostaddr)
+                if replication['ss']['Slave_IO_Running'] != 'Yes':
+                    raise Exception("IO thread is not running")
+
+            if replication['ss']['Slave_SQL_Running'] != 'Yes':
+                raise Exception("SQL thread is not running")
+
+            if replication['sbm'] < catch_up_sbm:
+                log.info('Replication computed seconds behind master {sbm} < '
+                         '{catch_up_sbm}'.format(sbm=replication['sbm'],
+                                                 catch_up_sbm=catch_up_sbm))
+                break
+
+            poller.record(replication['sbm'])
+            eta = poller.eta()
+            if eta is None:
+                remaining_time = 'Not yet available'
+            elif eta == float('inf'):
+                remaining_time = '> heat death of the universe'
+            else:
+                remaining_time = datetime.timedelta(seconds=int(eta))
             log.info('Replication is lagged by {sbm} seconds, waiting '
                      'for < {catch_up}. Guestimate time to catch up: {eta}'
                      ''.format(sbm=replication['sbm'],
                                catch_up=catch_up_sbm,
                                eta=str(remaining_time)))
-            last_sbm = replication['sbm']
-            if last_sbm > 24 * 60 * 60:
-                sleep_duration = 5 * 60
-            elif last_sbm > 60 * 60:
-                sleep_duration = 60
-            else:
-                sleep_duration = 5
-            time.sleep(sleep_duration)
-
 
-def calc_slave_lag(slave_hostaddr, dead_master=False):
+            if poller.expired():
+                raise PollTimeout('Replication did not catch up within '
+                                  '{timeout} seconds'.format(timeout=timeout))
+
+            # Wake up early if the replica reaches where the master was,
+            # as it is then likely to be caught up
+            interval = poller.next_interval()
+            master = host_utils.HostAddr(':'.join((replication['ss']['Master_Host'],
+                                                   str(replication['ss']['Master_Port']))))
+            wait_start = time.time()
+            min_wait = interval
+            try:
+                if target is None or target[0] != master:
+                    target = (master, get_master_status(connect_mysql(master)))
+                if wait_conn is None:
+                    read_timeout = None
+                    if READ_TIMEOUT is not None:
+                        read_timeout = (REPLICATION_POLL_MAX_INTERVAL +
+                                        READ_TIMEOUT)
+                    wait_conn = new_mysql_connection(slave_hostaddr,
+                                                     read_timeout=read_timeout)
+                log.debug('Waiting up to {interval:.1f} seconds for '
+                          '{replica} to reach {log_file}:{log_pos}'
+                          ''.format(interval=interval, replica=slave_hostaddr,
+                                    log_file=target[1]['File'],
+                                    log_pos=target[1]['Position']))
+                if master_pos_wait(slave_hostaddr, target[1]['File'],
+                                   target[1]['Position'], interval,
+                                   conn=wait_conn):
+                    target = None
+                    min_wait = REPLICATION_POLL_MIN_INTERVAL
+            except (ReplicationError, MySQLdb.OperationalError) as e:
+                log.debug('Could not wait on {replica}: '
+                          '{e}'.format(replica=slave_hostaddr, e=e))
+                target = None
+                if wait_conn is not None:
+                    wait_conn.close()
+                    wait_conn = None
+            time.sleep(max(min_wait - (time.time() - wait_start), 0))
+    finally:
+        if wait_conn is not None:
+            wait_conn.close()
+
+
+def calc_slave_lag(slave_hostaddr, dead_master=False, binlog_indexes=None):
     """Determine MySQL replication lag in bytes and binlogs
 
     Args:
     slave_hostaddr - object of host:port for the replica
+    dead_master - Do not try to connect to the master
+    binlog_indexes - Optionally, a dict keyed by master hostaddr of
+                     BinlogIndex objects. The master's binlogs are taken from
+                     here if present, and are added if not, so that replicas
+                     of the same master sampled together share one
+                     SHOW MASTER LOGS.
 
     Returns:
     io_binlogs - Number of undownloaded binlogs. This is only slightly useful
@@ -905,26 +2438,22 @@ def calc_slave_lag(slave_hostaddr, dead_master=False):
         return ret
 
     ret['ss'] = ss
-    slave_sql_pos = ss['Exec_Master_Log_Pos']
-    slave_sql_binlog = ss['Relay_Master_Log_File']
-    _, slave_sql_binlog_num = re.split('\.', slave_sql_binlog)
-    slave_io_pos = ss['Read_Master_Log_Pos']
-    slave_io_binlog = ss['Master_Log_File']
-    _, slave_io_binlog_num = re.split('\.', slave_io_binlog)
-
     master_hostaddr = host_utils.HostAddr(':'.join((ss['Master_Host'],
                                                     str(ss['Master_Port']))))
     if not dead_master:
         try:
-            master_conn = connect_mysql(master_hostaddr)
-            master_logs = get_master_logs(master_conn)
-
-            (ret['sql_bytes'], ret['sql_binlogs']) = calc_binlog_behind(slave_sql_binlog_num,
-                                                                        slave_sql_pos,
-                                                                        master_logs)
-            (ret['io_bytes'], ret['io_binlogs']) = calc_binlog_behind(slave_io_binlog_num,
-                                                                      slave_io_pos,
-                                                                      master_logs)
+            if binlog_indexes is None:
+                binlog_indexes = dict()
+            index = binlog_indexes.get(master_hostaddr)
+            # A shared index is older than this replica's slave status, so
+            # the replica may have read past its end
+            if index is None or index.is_past_end(
+                    get_binlog_num(ss['Master_Log_File']),
+                    ss['Read_Master_Log_Pos']):
+                master_conn = connect_mysql(master_hostaddr)
+                index = get_binlog_index(master_conn)
+                binlog_indexes[master_hostaddr] = index
+            ret.update(calc_binlog_lag(ss, index))
         except _mysql_exceptions.OperationalError as detail:
             (error_code, msg) = detail.args
             if error_code != MYSQL_ERROR_CONN_HOST_ERROR:
@@ -943,6 +2472,27 @@ def calc_slave_lag(slave_hostaddr, dead_master=False):
     return ret
 
 
+def calc_binlog_lag(slave_status, binlog_index):
+    """ Determine replication lag in bytes and binlogs from slave status
+
+    Args:
+    slave_status - a dict of slave status
+    binlog_index - A BinlogIndex object of the binlogs of the master
+
+    Returns:
+    A dict of sql_bytes, sql_binlogs, io_bytes and io_binlogs, see
+    calc_slave_lag
+    """
+    ret = dict()
+    (ret['sql_bytes'], ret['sql_binlogs']) = binlog_index.behind(
+        get_binlog_num(slave_status['Relay_Master_Log_File']),
+        slave_status['Exec_Master_Log_Pos'])
+    (ret['io_bytes'], ret['io_binlogs']) = binlog_index.behind(
+        get_binlog_num(slave_status['Master_Log_File']),
+        slave_status['Read_Master_Log_Pos'])
+    return ret
+
+
 def calc_alt_sbm(conn, slave_status):
     """ Calculate seconds behind using heartbeat + time on slave server
 
@@ -966,6 +2516,180 @@ def calc_alt_sbm(conn, slave_status):
         return None
 
 
+class ReplicationLagSampler(object):
+    """ Sample replication lag of many replicas at once, and estimate from a
+        rolling window of samples how fast each is catching up.
+
+    Each sample checks all replicas concurrently, then fetches the binlogs of
+    each of their masters once, however many replicas it has.
+    """
+
+    def __init__(self, replicas, window=LAG_RATE_WINDOW,
+                 catch_up_sbm=MAX_HEARTBEAT_LAG - HEARTBEAT_SAFETY_MARGIN):
+        """
+        Args:
+        replicas - An iterable of hostaddr objects
+        window - Number of samples per replica to estimate rates from
+        catch_up_sbm - Heartbeat lag in seconds below which a replica is
+                       considered caught up
+        """
+        self.replicas = set(replicas)
+        self.catch_up_sbm = catch_up_sbm
+        # hostaddr -> deque of (time, sbm, sql_bytes)
+        self.samples = dict()
+        self.samples_maxlen = window
+        for replica in self.replicas:
+            self.samples[replica] = collections.deque(maxlen=window)
+        # hostaddr -> dict from calc_slave_lag or an exception
+        self.latest = dict()
+
+    def set_replicas(self, replicas):
+        """ Change which replicas are sampled, for example after a topology
+            change. Samples of replicas which remain are kept.
+
+        Args:
+        replicas - An iterable of hostaddr objects
+        """
+        replicas = set(replicas)
+        for replica in self.replicas.difference(replicas):
+            del self.samples[replica]
+            self.latest.pop(replica, None)
+        for replica in replicas.difference(self.replicas):
+            self.samples[replica] = collections.deque(
+                maxlen=self.samples_maxlen)
+        self.replicas = replicas
+
+    def sample(self):
+        """ Sample the lag of every replica """
+        now = time.time()
+        (lags, errors) = run_on_instances(
+            self.replicas, lambda r: calc_slave_lag(r, dead_master=True))
+
+        masters = dict()
+        for replica in lags:
+            ss = lags[replica]['ss']
+            if ss['Master_Host'] == 'INVALID':
+                errors[replica] = ReplicationError('Could not get slave '
+                                                   'status')
+                continue
+            master = host_utils.HostAddr(':'.join((ss['Master_Host'],
+                                                   str(ss['Master_Port']))))
+            masters.setdefault(master, list()).append(replica)
+
+        (indexes, master_errors) = run_on_instances(
+            masters, lambda m: get_binlog_index(connect_mysql(m)))
+        for master in master_errors:
+            log.warning('Could not get binlogs of {master}, so there is no '
+                        'byte lag for {replicas}: {e}'
+                        ''.format(master=master,
+                                  replicas=', '.join(str(r) for r in
+                                                     masters[master]),
+                                  e=master_errors[master]))
+        for master in masters:
+            for replica in masters[master]:
+                lag = lags[replica]
+                if master in indexes:
+                    lag.update(calc_binlog_lag(lag['ss'], indexes[master]))
+                lag['master'] = master
+                self.latest[replica] = lag
+                self.samples[replica].append((now, lag['sbm'],
+                                              lag['sql_bytes']))
+
+        for replica in errors:
+            self.latest[replica] = errors[replica]
+
+    def rates(self, replica):
+        """ Estimate how fast a replica is applying replication, from the
+            oldest and newest samples in the window
+
+        Args:
+        replica - A hostaddr object
+
+        Returns:
+        A dict of
+        sbm_rate - Seconds of master time applied per second, or None
+        bytes_rate - Bytes of lag removed per second, negative if falling
+                     behind, or None
+        eta - Estimated seconds until caught up, None if unknown or not
+              catching up
+        """
+        ret = {'sbm_rate': None, 'bytes_rate': None, 'eta': None}
+        samples = self.samples[replica]
+        if not samples:
+            return ret
+
+        (last_time, last_sbm, last_bytes) = samples[-1]
+        for (first_time, first_sbm, first_bytes) in samples:
+            elapsed = last_time - first_time
+            if elapsed <= 0:
+                break
+            if (ret['sbm_rate'] is None and is_number(first_sbm) and
+                    is_number(last_sbm)):
+                ret['sbm_rate'] = float(elapsed - (last_sbm - first_sbm)) / elapsed
+            if (ret['bytes_rate'] is None and is_number(first_bytes) and
+                    is_number(last_bytes)):
+                ret['bytes_rate'] = float(first_bytes - last_bytes) / elapsed
+
+        if is_number(last_sbm):
+            if last_sbm < self.catch_up_sbm:
+                ret['eta'] = 0
+            elif ret['sbm_rate'] is not None and ret['sbm_rate'] > 1:
+                ret['eta'] = ((last_sbm - self.catch_up_sbm) /
+                              (ret['sbm_rate'] - 1))
+        elif is_number(last_bytes):
+            if last_bytes == 0:
+                ret['eta'] = 0
+            elif ret['bytes_rate'] is not None and ret['bytes_rate'] > 0:
+                ret['eta'] = last_bytes / ret['bytes_rate']
+        return ret
+
+    def report(self):
+        """ Describe the latest sample of every replica, worst first
+
+        Returns:
+        A list of dicts of replica, master, error, sbm, sql_bytes, io_bytes,
+        sbm_rate, bytes_rate and eta. Replicas which could not be sampled
+        have error set and come first.
+        """
+        ret = list()
+        for replica in self.latest:
+            latest = self.latest[replica]
+            if isinstance(latest, Exception):
+                ret.append({'replica': replica, 'master': None,
+                            'error': latest, 'sbm': None, 'sql_bytes': None,
+                            'io_bytes': None, 'sbm_rate': None,
+                            'bytes_rate': None, 'eta': None})
+                continue
+            entry = self.rates(replica)
+            entry.update({'replica': replica,
+                          'master': latest['master'],
+                          'error': None,
+                          'sbm': latest['sbm'],
+                          'sql_bytes': latest['sql_bytes'],
+                          'io_bytes': latest['io_bytes']})
+            ret.append(entry)
+
+        def severity(entry):
+            return (entry['error'] is None,
+                    -entry['sbm'] if is_number(entry['sbm']) else 0,
+                    -entry['sql_bytes'] if is_number(entry['sql_bytes']) else 0,
+                    str(entry['replica']))
+        ret.sort(key=severity)
+        return ret
+
+
+def is_number(value):
+    """ Check if a lag value is a usable number rather than None or 'INVALID'
+
+    Args:
+    value - A value from calc_slave_lag
+
+    Returns:
+    True if value is an int, long or float
+    """
+    return isinstance(value, (int, long, float)) and not isinstance(value, bool)
+
+
 def set_global_variable(conn, variable, value):
     """ Modify MySQL global variables
 
@@ -979,7 +2703,8 @@ def set_global_variable(conn, variable, value):
     # If we are enabling read only we need to kill all long running trx
     # so that they don't block the change
     if (variable == 'read_only' or variable == 'super_read_only') and value:
-        gvars = get_global_variables(conn)
+        # Not cached, acting on a stale value would be unsafe
+        gvars = get_global_variables(conn, ['super_read_only'])
         if 'super_read_only' in gvars and gvars['super_read_only'] == 'ON':
             # no use trying to set something that is already turned on
             return
@@ -988,7 +2713,10 @@ def set_global_variable(conn, variable, value):
     parameters = {'value': value}
     # Variable is not a string and can not be paramaretized as per normal
     sql = 'SET GLOBAL {variable} = %(value)s'.format(variable=variable)
-    cursor.execute(sql, parameters)
+    try:
+        cursor.execute(sql, parameters)
+    finally:
+        invalidate_global_variables(conn)
     log.info(cursor._executed)
 
 
@@ -1013,11 +2741,14 @@ def get_long_trx(conn):
     return threads
 
 
-def kill_long_trx(conn):
+def kill_long_trx(conn, timeout=None):
     """ Kill long running transaction.
 
     Args:
     conn - A mysql connection
+    timeout - If supplied, max seconds to wait for killed transactions to go
+              away before raising PollTimeout. By default wait for as long
+              as it takes them to roll back.
     """
     cursor = conn.cursor()
     threads_to_kill = get_long_trx(conn)
@@ -1035,6 +2766,11 @@ def kill_long_trx(conn):
                          'exists'.format(thr=thread))
 
     log.info('Confirming that long running transactions have gone away')
+    # This is on the failover path while the master is read_only, so never
+    # back off past the half second that was always polled at
+    poller = AdaptivePoller(0, min_interval=.1,
+                            max_interval=KILL_LONG_TRX_POLL_INTERVAL,
+                            timeout=timeout)
     while True:
         long_threads = get_long_trx(conn)
         not_dead = threads_to_kill.intersection(long_threads)
@@ -1042,7 +2778,8 @@ def kill_long_trx(conn):
         if not_dead:
             log.info('Threads of not dead yet: '
                      '{threads}'.format(threads=not_dead))
-            time.sleep(.5)
+            poller.record(len(not_dead))
+            poller.sleep()
         else:
             log.info('All long trx are now dead')
             return
@@ -1066,7 +2803,8 @@ def shutdown_mysql(instance):
 
 
 def get_mysqlops_connections():
-    """ Get a connection to mysqlops for reporting
+    """ Get a connection to mysqlops for reporting. This goes through
+        connect_mysql, so the connection is pooled if pooling is enabled.
 
     Returns:
     A mysql connection
@@ -1127,3 +2865,7 @@ def get_installed_mysqld_version():
         raise Exception('Could not determine installed mysql version: '
                         '{std_err}')
     return re.search('.+Ver ([0-9.-]+)', std_out).groups()[0]
+
+
+if os.environ.get(QUERY_STATS_ENV) or os.environ.get(QUERY_TRACE_ENV):
+    enable_query_stats(os.environ.get(QUERY_TRACE_ENV))
@@ -209,6 +209,7 @@ def main():
                         default=DB_CHECK_FRACTION)
 
     args = parser.parse_args()
+    mysql_lib.enable_connection_pool()
     instance = host_utils.HostAddr(args.instance)
     zk = host_utils.MysqlZookeeper()
 
@@ -272,9 +273,10 @@ def main():
     # loses its DB connection and errors out before completing a full scan
     # of a given database.
     #
+    conn = mysql_lib.connect_mysql(instance, 'scriptro')
+    catalog = mysql_lib.get_catalog(conn)
     for db in db_to_check:
-        conn = mysql_lib.connect_mysql(instance, 'scriptro')
-        tables_to_check = mysql_lib.get_tables(conn, db, skip_views=True)
+        tables_to_check = catalog.get_tables(db, skip_views=True)
         for tbl in tables_to_check:
             c_cmd, c_out, c_err, c_ret = checksum_tbl(instance, db, tbl)
             if not args.quiet:
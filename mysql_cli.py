@@ -65,14 +65,11 @@ def main():
 
     # Perhaps a shard?
     if not host:
-        shard_map = zk.get_host_shard_map()
-        for master in shard_map:
-            if args.db in shard_map[master]:
-                log.info('{db} appears to be a shard'.format(db=args.db))
-                host = host_utils.HostAddr(master)
-                db = args.db
-                break
-        if not host:
+        try:
+            host = zk.shard_to_instance(args.db)
+            log.info('{db} appears to be a shard'.format(db=args.db))
+            db = args.db
+        except host_utils.UnknownShardError:
             log.info('{db} appears not to be a shard'.format(db=args.db))
 
     if not host:
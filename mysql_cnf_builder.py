@@ -148,6 +148,7 @@ def build_cnf(host=None,
 
     # Write out the mysql cnf files
     create_mysql_cnf_files(parser, override_dir)
+    host_utils.invalidate_cnf_cache()
 
     # Create log rotate conf for MySQL
     create_log_rotate_conf(parser, override_dir)
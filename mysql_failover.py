@@ -15,6 +15,8 @@ MAX_ALIVE_MASTER_SLAVE_LAG_SECONDS = 60
 MAX_DEAD_MASTER_SLAVE_LAG_SECONDS = 3600
 MAX_ZK_WRITE_ATTEMPTS = 5
 WAIT_TIME_CONFIRM_QUIESCE = 10
+# Phase name under which the duration of an entire failover is recorded
+PHASE_TOTAL = 'total'
 
 
 def main():
@@ -49,13 +51,24 @@ def main():
                         action='store_true')
     args = parser.parse_args()
 
+    mysql_lib.enable_connection_pool()
     instance = host_utils.HostAddr(args.instance)
-    mysql_failover(instance, args.dry_run, args.skip_lock,
-                   args.ignore_dr_slave, args.trust_me_its_dead, args.kill_old_master)
+    timer = FailoverTimer(instance)
+    try:
+        mysql_failover(instance, args.dry_run, args.skip_lock,
+                       args.ignore_dr_slave, args.trust_me_its_dead,
+                       args.kill_old_master, timer)
+        timer.finish(True)
+    except:
+        timer.finish(False)
+        raise
+    finally:
+        timer.save()
 
 
 def mysql_failover(master, dry_run, skip_lock,
-                   ignore_dr_slave, trust_me_its_dead, kill_old_master):
+                   ignore_dr_slave, trust_me_its_dead, kill_old_master,
+                   timer=None):
     """ Promte a new MySQL master
 
     Args:
@@ -65,26 +78,34 @@ def mysql_failover(master, dry_run, skip_lock,
     ignore_dr_slave - Ignore the existance of a dr_slave
     trust_me_its_dead - Do not test to see if the master is dead
     kill_old_master - Send a mysqladmin kill command to the old master
+    timer - A FailoverTimer to record how long each phase takes
 
     Returns:
     new_master - The new master server
     """
+    if timer is None:
+        timer = FailoverTimer(master)
     log.info('Master to demote is {master}'.format(master=master))
 
+    timer.start_phase('zk_lookup')
     zk = host_utils.MysqlZookeeper()
     (replica_set, _) = zk.get_replica_set_from_instance(master, rtypes=['master'])
     log.info('Replica set is detected as '
              '{replica_set}'.format(replica_set=replica_set))
+    timer.replica_set = replica_set
 
     # take a lock here to make sure nothing changes underneath us
     if not skip_lock and not dry_run:
         log.info('Taking promotion lock on replica set')
+        timer.start_phase('lock')
         lock_identifier = get_promotion_lock(replica_set)
+        timer.lock_identifier = lock_identifier
     else:
         lock_identifier = None
 
     # giant try. If there any problems we roll back from the except
     try:
+        timer.start_phase('preflight')
         master_conn = False
         slave = zk.get_mysql_instance_from_replica_set(replica_set=replica_set,
                                                        repl_type=host_utils.REPLICA_ROLE_SLAVE)
@@ -105,8 +126,12 @@ def mysql_failover(master, dry_run, skip_lock,
         else:
             replicas = set([slave])
 
+        # Look at all replicas at once, rather than connecting to each of
+        # them again for every check
+        facts = gather_preflight_facts(replicas)
+
         # let's make sure that what we think is the master, actually is
-        confirm_replica_topology(master, replicas)
+        confirm_replica_topology(master, replicas, facts)
 
         # We use master_conn as a mysql connection to the master server, if
         # it is False, the master is dead
@@ -114,33 +139,42 @@ def mysql_failover(master, dry_run, skip_lock,
             master_conn = None
         else:
             master_conn = is_master_alive(master, replicas)
+            if not master_conn:
+                # is_master_alive restarted replication on the replicas, so
+                # what was seen before is out of date
+                facts = gather_preflight_facts(replicas)
         slave_conn = mysql_lib.connect_mysql(slave)
 
         # Test to see if the slave is setup for replication. If not, we are hosed
         log.info('Testing to see if Slave/new master is setup to write '
                  'replication logs')
-        try:
-            mysql_lib.get_master_status(slave_conn)
-        except mysql_lib.ReplicationError:
+        if facts[slave]['master_status'] is None:
             log.error('New master {slave} is not setup to write replicaiton '
                       'logs!'.format(slave=slave))
-            raise
+            raise mysql_lib.ReplicationError('Server is not setup to write '
+                                             'replication logs')
         log.info('Slave/new master is setup to write replication logs')
 
         if kill_old_master:
             log.info('Killing old master, we hope you know what you are doing')
+            timer.start_phase('kill_old_master')
             mysql_lib.shutdown_mysql(master)
             master_conn = None
 
         if master_conn:
             log.info('Master is considered alive')
             dead_master = False
-            confirm_max_replica_lag(replicas, MAX_ALIVE_MASTER_SLAVE_LAG_SECONDS,
-                                    dead_master=dead_master)
+            max_lag = MAX_ALIVE_MASTER_SLAVE_LAG_SECONDS
         else:
             log.info('Master is considered dead')
             dead_master = True
-            confirm_max_replica_lag(replicas, MAX_DEAD_MASTER_SLAVE_LAG_SECONDS,
+            max_lag = MAX_DEAD_MASTER_SLAVE_LAG_SECONDS
+        timer.dead_master = dead_master
+        timer.start_phase('replica_lag')
+        # Only go back to the replicas if the pre-flight look was not good
+        # enough, so that the usual errors are raised
+        if not preflight_lag_acceptable(replicas, max_lag, facts):
+            confirm_max_replica_lag(replicas, max_lag,
                                     dead_master=dead_master)
 
         if dry_run:
@@ -152,38 +186,48 @@ def mysql_failover(master, dry_run, skip_lock,
 
         if master_conn:
             log.info('Setting read_only on master')
+            timer.start_phase('read_only')
             mysql_lib.set_global_variable(master_conn, 'read_only', True)
             log.info('Confirming no writes to old master')
             # If there are writes with the master in read_only mode then the
             # promotion can not proceed.
             # A likely reason is a client has the SUPER privilege.
+            timer.start_phase('confirm_no_writes')
             confirm_no_writes(master_conn)
             log.info('Waiting for replicas to be caught up')
+            timer.start_phase('replica_convergence')
             confirm_max_replica_lag(replicas, 0,
                                     timeout=MAX_ALIVE_MASTER_SLAVE_LAG_SECONDS,
-                                    dead_master=dead_master)
+                                    dead_master=dead_master,
+                                    master=master)
             log.info('Setting up replication from old master ({master})'
                      'to new master ({slave})'.format(master=master,
                                                       slave=slave))
+            timer.start_phase('setup_replication')
             mysql_lib.setup_replication(new_master=slave, new_replica=master)
         else:
             log.info('Starting up a zk connection to make sure we can connect')
+            timer.start_phase('zk_connect')
             kazoo_client = environment_specific.get_kazoo_client()
             if not kazoo_client:
                 raise Exception('Could not conect to zk')
 
             log.info('Confirming replica has processed all replication '
                      ' logs')
+            timer.start_phase('confirm_no_writes')
             confirm_no_writes(slave_conn)
             log.info('Looks like no writes being processed by replica via '
                      'replication or other means')
             if len(replicas) > 1:
                 log.info('Confirming relpica servers in sync')
+                timer.start_phase('replica_convergence')
                 confirm_max_replica_lag(replicas, MAX_DEAD_MASTER_SLAVE_LAG_SECONDS,
                                         replicas_synced=True,
                                         dead_master=dead_master)
     except:
         log.info('Starting rollback')
+        timer.end_phase(False)
+        timer.start_phase('rollback')
         if master_conn:
             log.info('Releasing read_only on old master')
             mysql_lib.set_global_variable(master_conn, 'read_only', False)
@@ -193,10 +237,14 @@ def mysql_failover(master, dry_run, skip_lock,
         if lock_identifier:
             log.info('Releasing promotion lock')
             release_promotion_lock(lock_identifier)
+        # If the rollback itself raises, the phase is recorded as failed
+        # by FailoverTimer.finish
+        timer.end_phase()
         log.info('Rollback complete, reraising exception')
         raise
 
     if dr_slave:
+        timer.start_phase('dr_slave_replication')
         try:
             mysql_lib.setup_replication(new_master=slave, new_replica=dr_slave)
         except Exception as e:
@@ -205,6 +253,7 @@ def mysql_failover(master, dry_run, skip_lock,
                       'Failing forward!')
 
     log.info('Updating zk')
+    timer.start_phase('zk_swap')
     zk_write_attempt = 0
     while True:
         try:
@@ -219,16 +268,114 @@ def mysql_failover(master, dry_run, skip_lock,
                 zk_write_attempt = zk_write_attempt+1
 
     log.info('Removing read_only from new master')
+    timer.start_phase('new_master_read_write')
     mysql_lib.set_global_variable(slave_conn, 'read_only', False)
     log.info('Removing replication configuration from new master')
+    timer.start_phase('reset_slave')
     mysql_lib.reset_slave(slave_conn)
     if lock_identifier:
         log.info('Releasing promotion lock')
+        timer.start_phase('release_lock')
         release_promotion_lock(lock_identifier)
 
+    timer.end_phase()
     log.info('Failover complete')
 
 
+class FailoverTimer(object):
+    """ Record how long each phase of a failover takes, and save the timings
+        to mysqlops so that failovers can be compared.
+    """
+
+    def __init__(self, master):
+        """
+        Args:
+        master - Hostaddr object of the master instance to be demoted
+        """
+        self.failover_identifier = str(uuid.uuid4())
+        self.master = master
+        self.replica_set = None
+        self.lock_identifier = None
+        self.dead_master = None
+        self.started = time.time()
+        # (name, started, duration, success)
+        self.phases = list()
+        # (name, started) of the phase in progress
+        self.current = None
+
+    def start_phase(self, name):
+        """ End the phase in progress, if any, and start another
+
+        Args:
+        name - The name of the new phase
+        """
+        self.end_phase()
+        self.current = (name, time.time())
+
+    def end_phase(self, success=True):
+        """ End the phase in progress, if any
+
+        Args:
+        success - False if the phase failed
+        """
+        if self.current is None:
+            return
+        (name, started) = self.current
+        self.current = None
+        duration = time.time() - started
+        self.phases.append((name, started, duration, success))
+        log.info('Failover phase {name} took {duration:.3f} '
+                 'seconds'.format(name=name, duration=duration))
+
+    def finish(self, success):
+        """ End the failover
+
+        Args:
+        success - False if the failover failed
+        """
+        self.end_phase(success)
+        self.phases.append((PHASE_TOTAL, self.started,
+                            time.time() - self.started, success))
+
+    def save(self):
+        """ Save phase timings to mysqlops. Failure is logged rather than
+            raised, as the failover itself has already happened.
+        """
+        if not self.phases or self.replica_set is None:
+            return
+
+        sql = ('INSERT INTO mysqlops.failover_phases '
+               'SET '
+               'failover_identifier = %(failover_identifier)s, '
+               'lock_identifier = %(lock_identifier)s, '
+               'replica_set = %(replica_set)s, '
+               'old_master = %(old_master)s, '
+               'dead_master = %(dead_master)s, '
+               'phase = %(phase)s, '
+               'started = FROM_UNIXTIME(%(started)s), '
+               'duration = %(duration)s, '
+               'success = %(success)s')
+        rows = list()
+        for (name, started, duration, success) in self.phases:
+            rows.append({'failover_identifier': self.failover_identifier,
+                         'lock_identifier': self.lock_identifier,
+                         'replica_set': self.replica_set,
+                         'old_master': str(self.master),
+                         'dead_master': self.dead_master,
+                         'phase': name,
+                         'started': int(started),
+                         'duration': duration,
+                         'success': success})
+        try:
+            conn = mysql_lib.get_mysqlops_connections()
+            cursor = conn.cursor()
+            cursor.executemany(sql, rows)
+            conn.commit()
+        except Exception as e:
+            log.error('Could not save failover phase timings: '
+                      '{e}'.format(e=e))
+
+
 def get_promotion_lock(replica_set):
     """ Take a promotion lock
 
@@ -340,16 +487,92 @@ def release_promotion_lock(lock_identifier):
     log.info(cursor._executed)
 
 
-def confirm_replica_topology(master, replicas):
+def gather_preflight_facts(replicas):
+    """ Collect everything the pre-flight checks need to know about the
+        replicas, from all of them at once
+
+    Args:
+    replicas - A set of hostaddr objects for the replica instances
+
+    Returns:
+    A dict keyed by hostaddr, see get_instance_facts. Replicas which can not
+    be examined cause an exception to be raised.
+    """
+    (facts, errors) = mysql_lib.run_on_instances(replicas, get_instance_facts)
+    for replica in replicas:
+        if replica in errors:
+            raise errors[replica]
+    return facts
+
+
+def get_instance_facts(instance):
+    """ Collect facts about a replica for the failover pre-flight checks
+
+    Args:
+    instance - A hostaddr object
+
+    Returns:
+    A dict of
+    master_status - A dict from get_master_status, or None if the replica
+                    does not write replication logs
+    ss - Slave status
+    sbm - Heartbeat lag from calc_alt_sbm, or None
+    """
+    conn = mysql_lib.connect_mysql(instance)
+    facts = dict()
+    try:
+        facts['master_status'] = mysql_lib.get_master_status(conn)
+    except mysql_lib.ReplicationError:
+        facts['master_status'] = None
+    facts['ss'] = mysql_lib.get_slave_status(conn)
+    try:
+        facts['sbm'] = mysql_lib.calc_alt_sbm(conn, facts['ss'])
+    except MySQLdb.ProgrammingError as detail:
+        (error_code, msg) = detail.args
+        if error_code != mysql_lib.MYSQL_ERROR_NO_SUCH_TABLE:
+            raise
+        facts['sbm'] = None
+    return facts
+
+
+def preflight_lag_acceptable(replicas, max_lag, facts):
+    """ Check replication lag as seen by gather_preflight_facts
+
+    Args:
+    replicas - A set of hostaddr objects for the replica instances
+    max_lag - Max computed replication lag in seconds
+    facts - A dict from gather_preflight_facts
+
+    Returns:
+    True if all replicas were running and lagged by no more than max_lag
+    """
+    for replica in replicas:
+        if (facts[replica]['sbm'] is None or
+                facts[replica]['ss']['Slave_SQL_Running'] != 'Yes' or
+                facts[replica]['sbm'] > max_lag):
+            return False
+        log.info('Lag on {replica} is {lag} is <= limit of '
+                 '{limit}'.format(replica=replica,
+                                  limit=max_lag,
+                                  lag=facts[replica]['sbm']))
+    return True
+
+
+def confirm_replica_topology(master, replicas, facts=None):
     """ Confirm that replica servers are actually replicating off of a master
 
     Args:
     master - A hostaddr object for the master instance
     replicas - A set of hostaddr objects for the replica instance
+    facts - Optionally, a dict from gather_preflight_facts to use rather than
+            connecting to the replicas
     """
     for replica in replicas:
-        conn = mysql_lib.connect_mysql(replica)
-        ss = mysql_lib.get_slave_status(conn)
+        if facts is not None:
+            ss = facts[replica]['ss']
+        else:
+            conn = mysql_lib.connect_mysql(replica)
+            ss = mysql_lib.get_slave_status(conn)
         repl_master = host_utils.HostAddr(':'.join((ss['Master_Host'],
                                                     str(ss['Master_Port']))))
         if repl_master != master:
@@ -365,7 +588,7 @@ def confirm_replica_topology(master, replicas):
 
 
 def confirm_max_replica_lag(replicas, max_lag, dead_master,
-                            replicas_synced=False, timeout=0):
+                            replicas_synced=False, timeout=0, master=None):
     """ Test replication lag
 
     Args:
@@ -377,13 +600,31 @@ def confirm_max_replica_lag(replicas, max_lag, dead_master,
     replicas_synced - Replica servers must have executed to the same
                       position in the binary log.
     timeout - How long to wait for replication to be in the desired state
+    master - If supplied along with a max_lag of 0 and a live master, wait
+             server side for the replicas to reach the master's current
+             position before checking, rather than polling
     """
     repl_checks = dict()
     start = time.time()
+    poller = mysql_lib.AdaptivePoller(max_lag, min_interval=.5, max_interval=5,
+                                      timeout=timeout)
+    if max_lag == 0 and master and not dead_master and timeout:
+        try:
+            mysql_lib.wait_for_master_pos(master, replicas, timeout)
+        except (mysql_lib.ReplicationError, MySQLdb.OperationalError) as e:
+            log.warning('Could not wait for replicas to reach the master '
+                        'position, falling back to polling: {e}'.format(e=e))
+
     while True:
         acceptable = True
+        # The furthest behind replica, in the units of max_lag
+        worst = 0
+        # Replicas of the same master share one look at its binlogs
+        binlog_indexes = dict()
         for replica in replicas:
-            repl_check = mysql_lib.calc_slave_lag(replica, dead_master=dead_master)
+            repl_check = mysql_lib.calc_slave_lag(replica,
+                                                  dead_master=dead_master,
+                                                  binlog_indexes=binlog_indexes)
             repl_checks[replica.__str__()] = ':'.join((repl_check['ss']['Relay_Master_Log_File'],
                                                        str(repl_check['ss']['Exec_Master_Log_Pos'])))
             # Basic sanity
@@ -399,6 +640,8 @@ def confirm_max_replica_lag(replicas, max_lag, dead_master,
             if max_lag == 0:
                 if repl_check['sql_bytes'] != 0:
                     acceptable = False
+                    if isinstance(repl_check['sql_bytes'], (int, long)):
+                        worst = max(worst, repl_check['sql_bytes'])
                     log.warn('Unprocessed log on {replica} is {sql_bytes} '
                              'bytes  > 0'
                              ''.format(replica=replica,
@@ -409,6 +652,7 @@ def confirm_max_replica_lag(replicas, max_lag, dead_master,
             else:
                 if repl_check['sbm'] > max_lag:
                     acceptable = False
+                    worst = max(worst, repl_check['sbm'])
                     log.warn('Lag on {replica} is {lag} seconds is greater '
                              'than limit of '
                              '{limit}'.format(replica=replica,
@@ -430,8 +674,11 @@ def confirm_max_replica_lag(replicas, max_lag, dead_master,
         elif (time.time() - start) > timeout:
             raise Exception('Replication is not in an acceptable state')
         else:
-            log.info('Sleeping for 5 second to allow replication to catch up')
-            time.sleep(5)
+            poller.record(worst)
+            interval = poller.next_interval()
+            log.info('Sleeping for {interval:.1f} seconds to allow replication '
+                     'to catch up'.format(interval=interval))
+            time.sleep(interval)
 
 
 def is_master_alive(master, replicas):
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+import argparse
+import math
+
+import MySQLdb.cursors
+
+from lib import mysql_lib
+
+DEFAULT_DAYS = 365
+
+
+def main():
+    parser = argparse.ArgumentParser(description=('Report how long each '
+                                                  'phase of a failover takes'))
+    parser.add_argument('-d',
+                        '--days',
+                        help='How many days of failovers to report on',
+                        default=DEFAULT_DAYS,
+                        type=int)
+    parser.add_argument('-r',
+                        '--replica_set',
+                        help='Only report on a single replica set',
+                        default=None)
+    parser.add_argument('--include_failed',
+                        help=('Include phases that failed, and phases of '
+                              'failovers that were rolled back'),
+                        default=False,
+                        action='store_true')
+    args = parser.parse_args()
+    durations = get_phase_durations(args.days, args.replica_set,
+                                    args.include_failed)
+    print_phase_report(durations)
+
+
+def get_phase_durations(days, replica_set=None, include_failed=False):
+    """ Get the durations of failover phases from mysqlops
+
+    Args:
+    days - How many days back to look
+    replica_set - If supplied, only look at this replica set
+    include_failed - If True, include failed phases and failovers
+
+    Returns:
+    A dict keyed by (dead_master, phase) whose values are lists of durations
+    in seconds. Phases that failed are reported as "<phase> (failed)".
+    """
+    conn = mysql_lib.get_mysqlops_connections()
+    cursor = conn.cursor(MySQLdb.cursors.DictCursor)
+    params = {'days': days,
+              'replica_set': replica_set}
+    sql = ('SELECT p.dead_master, p.phase, p.duration, p.success '
+           'FROM mysqlops.failover_phases AS p ')
+    if not include_failed:
+        # Only look at phases of failovers that completed, otherwise a
+        # rolled back failover drags down the numbers for every phase it
+        # got through.
+        sql += ('INNER JOIN mysqlops.failover_phases AS t '
+                '    ON t.failover_identifier = p.failover_identifier '
+                '    AND t.phase = \'total\' '
+                '    AND t.success = 1 ')
+    sql += 'WHERE p.started > NOW() - INTERVAL %(days)s DAY '
+    if replica_set:
+        sql += 'AND p.replica_set = %(replica_set)s '
+    cursor.execute(sql, params)
+
+    durations = dict()
+    for row in cursor.fetchall():
+        phase = row['phase']
+        if not row['success']:
+            phase = '{phase} (failed)'.format(phase=phase)
+        key = (row['dead_master'], phase)
+        if key not in durations:
+            durations[key] = list()
+        durations[key].append(row['duration'])
+    return durations
+
+
+def calc_percentile(values, percentile):
+    """ Calculate a percentile using the nearest rank method
+
+    Args:
+    values - A list of numbers
+    percentile - A number between 0 and 100
+
+    Returns:
+    The value at the percentile
+    """
+    ordered = sorted(values)
+    rank = int(math.ceil(percentile / 100.0 * len(ordered))) - 1
+    return ordered[min(max(rank, 0), len(ordered) - 1)]
+
+
+def print_phase_report(durations):
+    """ Print count, p50, p95 and max duration per phase, slowest p95 first
+
+    Args:
+    durations - The output of get_phase_durations
+    """
+    if not durations:
+        print 'No failovers found'
+        return
+
+    print ('{master:<7} {phase:<24} {count:>6} {p50:>10} {p95:>10} '
+           '{max:>10}'.format(master='master', phase='phase', count='count',
+                              p50='p50', p95='p95', max='max'))
+    rows = list()
+    for (dead_master, phase) in durations:
+        values = durations[(dead_master, phase)]
+        rows.append((dead_master, phase, len(values),
+                     calc_percentile(values, 50),
+                     calc_percentile(values, 95),
+                     max(values)))
+    rows.sort(key=lambda row: (row[0], -row[4]))
+    for (dead_master, phase, count, p50, p95, longest) in rows:
+        if dead_master is None:
+            master = 'unknown'
+        elif dead_master:
+            master = 'dead'
+        else:
+            master = 'alive'
+        print ('{master:<7} {phase:<24} {count:>6} {p50:>10.3f} {p95:>10.3f} '
+               '{max:>10.3f}'.format(master=master, phase=phase, count=count,
+                                     p50=p50, p95=p95, max=longest))
+
+
+if __name__ == "__main__":
+    main()
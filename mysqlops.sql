@@ -1,3 +1,19 @@
+CREATE TABLE `failover_phases` (
+  `id` int(10) unsigned NOT NULL AUTO_INCREMENT,
+  `failover_identifier` varchar(36) NOT NULL,
+  `lock_identifier` varchar(36) DEFAULT NULL,
+  `replica_set` varchar(64) NOT NULL,
+  `old_master` varchar(90) NOT NULL,
+  `dead_master` tinyint(1) DEFAULT NULL,
+  `phase` varchar(64) NOT NULL,
+  `started` datetime NOT NULL,
+  `duration` double NOT NULL,
+  `success` tinyint(1) NOT NULL,
+  PRIMARY KEY (`id`),
+  KEY `failover_identifier` (`failover_identifier`),
+  KEY `phase` (`phase`,`started`)
+) ENGINE=InnoDB DEFAULT CHARSET=latin1;
+
 CREATE TABLE `host_replacement_log` (
   `old_host` varchar(90) NOT NULL,
   `old_instance` varchar(15) NOT NULL,
@@ -54,6 +54,7 @@ def main():
                               "optional otherwise"),
                         default=None)
     args = parser.parse_args()
+    mysql_lib.enable_connection_pool()
 
     if args.dry_run:
         log.removeHandler(chat_handler)
@@ -102,10 +103,9 @@ def add_to_queue(hostname, dry_run):
 
     # basic sanity check
     zk = host_utils.MysqlZookeeper()
-    for instance in zk.get_all_mysql_instances():
-        if instance.hostname == hostname:
-            raise Exception("It appears {instance} is in zk. This is "
-                            "very dangerous!".format(instance=instance))
+    if zk.get_replica_sets_from_hostname(hostname):
+        raise Exception("It appears {hostname} is in zk. This is "
+                        "very dangerous!".format(hostname=hostname))
     all_servers = environment_specific.get_all_server_metadata()
     if not hostname in all_servers:
         raise Exception('Host {hostname} is not cmdb'.format(hostname=hostname))
@@ -159,12 +159,11 @@ def process_mysql_shutdown(hostname=None, dry_run=False):
                         'retirement'.format(hostname=hostname))
             remove_from_retirement_queue(hostname)
             continue
-        for active_instance in zk.get_all_mysql_instances():
-            if active_instance.hostname == instance:
-                log.warning("It appears {instance} is in zk. This is "
-                            "very dangerous!".format(instance=instance))
-                remove_from_retirement_queue(instance)
-                continue
+        if zk.get_replica_sets_from_hostname(instance):
+            log.warning("It appears {instance} is in zk. This is "
+                        "very dangerous!".format(instance=instance))
+            remove_from_retirement_queue(instance)
+            continue
         log.info('Checking activity on {instance}'.format(instance=instance))
         # check mysql activity
         with timeout.timeout(3):
@@ -227,12 +226,11 @@ def terminate_instances(hostname=None, dry_run=False):
                         'retirement'.format(hostname=hostname))
             remove_from_retirement_queue(hostname)
             continue
-        for instance in zk.get_all_mysql_instances():
-            if instance.hostname == hostname:
-                log.warning("It appears {instance} is in zk. This is "
-                            "very dangerous!".format(instance=instance))
-                remove_from_retirement_queue(hostname)
-                continue
+        if zk.get_replica_sets_from_hostname(hostname):
+            log.warning("It appears {hostname} is in zk. This is "
+                        "very dangerous!".format(hostname=hostname))
+            remove_from_retirement_queue(hostname)
+            continue
 
         log.info('Confirming mysql is down on '
                  '{hostname}'.format(hostname=hostname))
@@ -3,12 +3,15 @@ import argparse
 import hashlib
 import sys
 import difflib
+from lib import environment_specific
 from lib import host_utils
 from lib import mysql_lib
 
 MODSHARDDB_PREFIX = 'moddb'
 SHARDDB_PREFIX = 'db'
 
+log = environment_specific.setup_logging_defaults(__name__)
+
 
 def main():
     parser = argparse.ArgumentParser(description='MySQL schema verifier')
@@ -25,6 +28,8 @@ def main():
                         help=('Which db on --seed_instance from which to fetch'
                               ' a table definition. (ex pbdata012345)'))
     args = parser.parse_args()
+    mysql_lib.set_io_timeouts(mysql_lib.FLEET_HOST_TIMEOUT,
+                              mysql_lib.FLEET_HOST_TIMEOUT)
     if args.instance_type == 'sharddb':
         zk_prefix = SHARDDB_PREFIX
     elif args.instance_type == 'modsharddb':
@@ -34,8 +39,10 @@ def main():
     desired = mysql_lib.show_create_table(seed_conn, args.seed_db, args.table)
     tbl_hash = hashlib.md5(desired).hexdigest()
     print ("Desired table definition:\n{desired}").format(desired=desired)
-    incorrect = check_schema(zk_prefix, args.table, tbl_hash)
-    if len(incorrect) == 0:
+    (incorrect, errors) = check_schema(zk_prefix, args.table, tbl_hash)
+    for instance in errors:
+        print 'Could not check {i}: {e}'.format(i=instance, e=errors[instance])
+    if len(incorrect) == 0 and not errors:
         print "It appears that all schema is synced"
         sys.exit(0)
 
@@ -64,13 +71,17 @@ def check_schema(zk_prefix, tablename, tbl_hash):
     tbl_hash - the md5sum of the desired CREATE TABLE for the table
 
     Returns:
-    A dictionary with keys that are the hash of the CREATE TABLE statement
-    and the values are sets of hostname:port followed by a space and then the
-    db one which the incorrect schema was found.
+    incorrect - A dictionary with keys that are the hash of the CREATE TABLE
+                statement and the values are sets of hostname:port followed
+                by a space and then the db one which the incorrect schema was
+                found.
+    errors - A dict keyed by hostaddr of the exception raised while checking
+             an instance
     """
     incorrect = dict()
     zk = host_utils.MysqlZookeeper()
     config = zk.get_ds_mysql_config()
+    instances = set()
     for db in config.iteritems():
         if db[0].startswith(zk_prefix):
             master = host_utils.HostAddr(''.join((db[1]['master']['host'],
@@ -79,17 +90,21 @@ def check_schema(zk_prefix, tablename, tbl_hash):
             slave = host_utils.HostAddr(''.join((db[1]['slave']['host'],
                                                  ':',
                                                  str(db[1]['slave']['port']))))
-            master_hashes = check_instance_table(master, tablename, tbl_hash)
-            slave_hashes = check_instance_table(slave, tablename, tbl_hash)
-            for entry in master_hashes.iteritems():
-                if entry[0] not in incorrect:
-                    incorrect[entry[0]] = set()
-                incorrect[entry[0]] = incorrect[entry[0]].union(entry[1])
-            for entry in slave_hashes.iteritems():
-                if entry[0] not in incorrect:
-                    incorrect[entry[0]] = set()
-                incorrect[entry[0]] = incorrect[entry[0]].union(entry[1])
-    return incorrect
+            instances.add(master)
+            instances.add(slave)
+
+    (hashes, errors) = mysql_lib.run_on_instances(
+        instances, lambda i: check_instance_table(i, tablename, tbl_hash))
+    for instance_hashes in hashes.itervalues():
+        for entry in instance_hashes.iteritems():
+            if entry[0] not in incorrect:
+                incorrect[entry[0]] = set()
+            incorrect[entry[0]] = incorrect[entry[0]].union(entry[1])
+
+    for instance in errors:
+        log.error('Could not check {i}: {e}'.format(i=instance,
+                                                   e=errors[instance]))
+    return incorrect, errors
 
 
 def check_instance_table(hostaddr, table, desired_hash):
@@ -107,8 +122,13 @@ def check_instance_table(hostaddr, table, desired_hash):
     """
     ret = dict()
     conn = mysql_lib.connect_mysql(hostaddr)
-    for db in mysql_lib.get_dbs(conn):
-        definition = mysql_lib.show_create_table(conn, db, table)
+    catalog = mysql_lib.get_catalog(conn)
+    for db in catalog.get_dbs():
+        if catalog.does_table_exist(db, table):
+            definition = mysql_lib.show_create_table(conn, db, table)
+        else:
+            # Same as show_create_table for a missing table
+            definition = ''
         tbl_hash = hashlib.md5(definition).hexdigest()
         if tbl_hash != desired_hash:
             if tbl_hash not in ret: